@@ -0,0 +1,152 @@
+import argparse
+import os
+import torch
+import models
+
+from nerf import batchify, create_memmap_arrays, fibonacci_directions, spherical_harmonics
+from lightning_modules import PathParser
+
+
+def bake_density(model, args, device):
+    # Lattice points spanning the grid
+    tiles = torch.linspace(-args.limit, args.limit, args.res)
+    samples = torch.stack(torch.meshgrid(tiles, tiles, tiles), -1).view(-1, 3)
+
+    density = []
+    for (samples,) in batchify(samples, batch_size=args.batch_size, device=device):
+        # Query density batch
+        radiance_batch = model.sample_points(samples, samples)
+
+        # Accumulate density
+        density.append(torch.nn.functional.relu(radiance_batch[..., 3]).cpu())
+
+    return torch.cat(density, 0)
+
+
+def bake_appearance(model, points, args, device):
+    # Viewing directions, the view dependent colour is projected onto the spherical harmonics basis
+    directions = fibonacci_directions(args.num_views).to(device)
+    basis_inv = torch.pinverse(spherical_harmonics(directions, args.sh_degree))
+
+    coefficients = []
+    batch_size = max(args.batch_size // args.num_views, 1)
+    for (points_batch,) in batchify(points, batch_size=batch_size, device=device):
+        # Query each point from all the views
+        points_views = points_batch[:, None, :].expand(-1, args.num_views, -1).reshape(-1, 3)
+        directions_views = directions.repeat(points_batch.shape[0], 1)
+        rgb = model.sample_points(points_views, directions_views)[..., :3].view(-1, args.num_views, 3)
+
+        # Least squares fit of the coefficients, (batch, 3, coefficients)
+        coefficients_batch = torch.einsum("cv,bvk->bkc", basis_inv, rgb)
+
+        # Accumulate coefficients
+        coefficients.append(coefficients_batch.reshape(points_batch.shape[0], -1).cpu())
+
+    return torch.cat(coefficients, 0)
+
+
+def bake(model, args, device):
+    print("Baking density...")
+    density = bake_density(model, args, device)
+
+    # Occupied lattice points, dilated such that the interpolation around the surface remains exact
+    occupied = (density > args.density_threshold).float().view(1, 1, *(args.res,) * 3)
+    occupied = torch.nn.functional.max_pool3d(occupied, kernel_size=3, stride=1, padding=1).view(-1) > 0
+
+    count = int(occupied.sum())
+    print(f"Occupied {count} out of {occupied.shape[0]} lattice points")
+
+    # Lattice points of the occupied slots
+    tiles = torch.linspace(-args.limit, args.limit, args.res)
+    points = torch.stack(torch.meshgrid(tiles, tiles, tiles), -1).view(-1, 3)[occupied]
+
+    print("Baking appearance...")
+    coefficients = bake_appearance(model, points, args, device)
+
+    # Write into a memory-mappable file
+    dtype = "float16" if args.half else "float32"
+    features_size = 1 + coefficients.shape[-1]
+    arrays = create_memmap_arrays(args.save_path, {
+        "index": ((args.res ** 3,), "int32"),
+        "features": ((count, features_size), dtype),
+    }, meta={
+        "res": args.res,
+        "limit": args.limit,
+        "sh_degree": args.sh_degree,
+    })
+
+    index = torch.full((args.res ** 3,), -1, dtype=torch.int)
+    index[occupied] = torch.arange(count, dtype=torch.int)
+    arrays["index"][:] = index.numpy()
+    arrays["features"][:] = torch.cat((density[occupied][:, None], coefficients), -1).numpy()
+
+    for array in arrays.values():
+        array.flush()
+
+    print(f"Baked grid saved to {args.save_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--log-checkpoint", type=str, default=None,
+        help="Training log path with the config and checkpoints to load existent configuration.",
+    )
+    parser.add_argument(
+        "--checkpoint", type=str, default="model_last.ckpt",
+        help="Load existent configuration from the latest checkpoint by default.",
+    )
+    parser.add_argument(
+        "--save-dir", type=str, default=".",
+        help="Save the baked grid to this directory, if specified.",
+    )
+    parser.add_argument(
+        "--name", type=str, default="baked",
+        help="Baked grid name, the (.bin) data and the (.json) index are generated.",
+    )
+    parser.add_argument(
+        "--limit", type=float, default=1.2,
+        help="Limits in -xyz to xyz for the baked 3D grid.",
+    )
+    parser.add_argument(
+        "--res", type=int, default=256,
+        help="Sampling resolution for the baked grid, increase it for higher level of detail.",
+    )
+    parser.add_argument(
+        "--density-threshold", type=float, default=1.0,
+        help="Density below which the lattice points are considered empty.",
+    )
+    parser.add_argument(
+        "--sh-degree", type=int, default=2, choices=[0, 1, 2],
+        help="Spherical harmonics degree of the view dependent colour, 0 for diffuse only.",
+    )
+    parser.add_argument(
+        "--num-views", type=int, default=32,
+        help="Number of viewing directions queried per lattice point to fit the view dependent colour.",
+    )
+    parser.add_argument(
+        "--half", action="store_true", default=False,
+        help="Store the features in half precision.",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=65536,
+        help="Higher batch size results in faster processing but needs more device memory.",
+    )
+    config_args = parser.parse_args()
+    config_args.save_path = os.path.join(config_args.save_dir, config_args.name)
+
+    # Existent log path
+    path_parser = PathParser()
+    cfg, _ = path_parser.parse(None, config_args.log_checkpoint, None, config_args.checkpoint)
+
+    # Available device
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    # Load model checkpoint
+    print(f"Loading model from {path_parser.checkpoint_path}")
+    model = getattr(models, cfg.experiment.model).load_from_checkpoint(path_parser.checkpoint_path)
+    model = model.eval().to(device)
+
+    with torch.no_grad():
+        # Bake the model into a sparse grid
+        bake(model, config_args, device)
@@ -37,14 +37,10 @@ def pose_spherical(theta, phi, radius):
     return c2w.astype(np.float32)
 
 
-def batch_random_sampling(cfg, coords, ray_bundle: tuple):
-    # Random 2D samples
-    select_inds = torch.randperm(coords.shape[0])[:cfg.nerf.train.num_random_rays]
-    select_inds = coords[select_inds]
-
-    # Unpack ray bundle and select random sub-samples
+def batch_random_sampling(select_inds, ray_bundle: tuple):
+    # Unpack ray bundle and select random sub-samples by their linear pixel indices
     ray_bundle = tuple([
-        ray_batch[select_inds[:, 0], select_inds[:, 1], ...] if ray_batch is not None else None
+        ray_batch.flatten(0, 1)[select_inds] if ray_batch is not None else None
         for ray_batch in ray_bundle
     ])
 
@@ -84,6 +80,8 @@ class DataBundle:
     ray_bounds: torch.Tensor = None
     target_depth: torch.Tensor = None
     target_normals: torch.Tensor = None
+    ray_images: torch.Tensor = None
+    ray_pixels: torch.Tensor = None
     poses: torch.Tensor = None
     size: int = -1
     hwf: tuple = None
@@ -135,7 +133,7 @@ class DataBundle:
         """ Removes all unnecessary dimensions from a ray batch. """
         self.ray_origins = self.ray_origins.view(-1, 3)
         self.ray_directions = self.ray_directions.view(-1, 3)
-        self.ray_bounds = self.ray_bounds.view(2)
+        self.ray_bounds = self.ray_bounds.view(2) if self.ray_bounds.numel() == 2 else self.ray_bounds.view(-1, 2)
 
         if self.ray_targets is not None:
             self.ray_targets = self.ray_targets.view(-1, 3)
@@ -143,6 +141,10 @@ class DataBundle:
         if self.target_depth is not None:
             self.target_depth = self.target_depth.view(-1)
 
+        if self.ray_pixels is not None:
+            self.ray_images = self.ray_images.view(-1)
+            self.ray_pixels = self.ray_pixels.view(-1)
+
         return self
 
     def to(self, device):
@@ -15,9 +15,10 @@ from torch.utils.data import Dataset
 from data.loaders.load_blender import load_blender_data
 from data.loaders.load_colmap import read_model
 from data.loaders.load_llff import load_llff_data
-from nerf import get_ray_bundle, meshgrid_xy
+from nerf import get_ray_bundle, meshgrid_xy, create_memmap_arrays, load_memmap_arrays
 from data import batch_random_sampling, pose_spherical
 from data.data_helpers import DataBundle
+from data.samplers import create_pixel_sampler, ImportancePixelSampler
 
 
 class DatasetType(Enum):
@@ -130,6 +131,33 @@ class SynthesizableDataset(Dataset):
         )
 
 
+class RayBatchSampler(torch.utils.data.Sampler):
+    """ Draws ray batches uniformly across all the training images from a single permutation of the rays,
+    which is reshuffled once every ray has been drawn. An epoch keeps one batch per image.
+    """
+
+    def __init__(self, dataset, batch_size):
+        self.ray_count = dataset.global_ray_count
+        self.batch_size = batch_size
+        self.epoch_size = len(dataset)
+
+        self.permutation = torch.randperm(self.ray_count)
+        self.offset = 0
+
+    def __len__(self):
+        return self.epoch_size
+
+    def __iter__(self):
+        for _ in range(self.epoch_size):
+            if self.offset + self.batch_size > self.ray_count:
+                # Every ray has been drawn, reshuffle
+                self.permutation = torch.randperm(self.ray_count)
+                self.offset = 0
+
+            yield self.permutation[self.offset:self.offset + self.batch_size]
+            self.offset += self.batch_size
+
+
 class CachingDataset(SynthesizableDataset, Dataset):
 
     def __init__(self, cfg, type):
@@ -146,7 +174,20 @@ class CachingDataset(SynthesizableDataset, Dataset):
         self.synthetic_bundle = None
 
         # Dataset filters
-        self.filters = ["ray_origins", "ray_directions", "ray_targets", "ray_bounds", "target_depth", "size", "hwf"]
+        self.filters = ["ray_origins", "ray_directions", "ray_targets", "ray_bounds", "target_depth", "ray_images", "ray_pixels", "size", "hwf"]
+
+        # Memory-mapped cache, a single contiguous file per split
+        self.use_memmap = self.cfg.dataset.caching.get("format", "torch") == "memmap"
+        self.memmap_fields = ["ray_origins", "ray_directions", "ray_targets", "ray_bounds", "target_depth", "target_normals"]
+        self.memmap_meta = None
+        self._memmap_arrays = None
+
+        # Pixel sampler of the training ray batches
+        self.pixel_sampler = None
+
+        # Ray batches drawn across all the training images
+        self.global_sampling = self.type == DatasetType.TRAIN and self.cfg.nerf.train.get("sampling", "image") == "global"
+        self.global_rays = None
 
         # Default experiment ray bounds
         self.ray_bounds = torch.tensor([self.cfg.dataset.near, self.cfg.dataset.far]).float()
@@ -177,17 +218,23 @@ class CachingDataset(SynthesizableDataset, Dataset):
             else:
                 print(f"Using existent cached dataset from {self.path}...")
 
-            self.paths = glob.glob(os.path.join(self.path, "*.data"))
+            self.paths = self.cached_paths()
             if len(self.paths) == 0:
                 if cache_dir_exists:
                     print(f"The previous cached dataset is corrupted in {self.path}, overriding it...")
                     self.cache_dataset()
 
-            self.paths = glob.glob(os.path.join(self.path, "*.data"))
+            self.paths = self.cached_paths()
             assert len(self.paths) > 0, f"There is a critical issue when caching the dataset"
 
-            self.init_sampling(torch.load(self.paths[0])['hwf'])
-            size = len(self.paths)
+            if self.use_memmap:
+                # Only the index is read, the arrays are mapped lazily within each worker
+                _, self.memmap_meta = load_memmap_arrays(self.memmap_path)
+                self.init_sampling(tuple(self.memmap_meta["hwf"]))
+                size = self.memmap_meta["size"]
+            else:
+                self.init_sampling(torch.load(self.paths[0])['hwf'])
+                size = len(self.paths)
         else:
             self.data_bundle = self.load_dataset()
 
@@ -208,42 +255,130 @@ class CachingDataset(SynthesizableDataset, Dataset):
         else:
             print(f"Load whole dataset into the memory {time_last}s seconds...")
 
+        if self.global_sampling:
+            self.init_global_sampling()
+        elif self.type == DatasetType.TRAIN:
+            self.init_pixel_sampler()
+
     def __len__(self):
         if self.synthetic_bundle is not None:
             return self.synthetic_bundle.size
 
-        return len(self.paths) if self.cfg.dataset.caching.use_caching else self.data_bundle.size
+        if self.cfg.dataset.caching.use_caching:
+            return self.memmap_meta["size"] if self.use_memmap else len(self.paths)
+
+        return self.data_bundle.size
 
     def __getitem__(self, idx):
-        # Retrieve bundle sample
-        if self.cfg.dataset.caching.use_caching:
-            bundle = DataBundle.deserialize(torch.load(self.paths[idx]))
+        # Ray batch of the global indices drawn by the RayBatchSampler
+        if self.global_sampling:
+            return self.load_global_batch(idx).serialize(self.filters)
+
+        select_inds = self.pixel_sampler.sample(idx) if self.type == DatasetType.TRAIN else None
+        if self.cfg.dataset.caching.use_caching and self.use_memmap:
+            # Read only the selected rays from the mapped arrays
+            bundle = self.load_memmap_bundle(idx, select_inds)
         else:
-            if self.synthetic_bundle is not None:
-                bundle = self.synthetic_bundle[idx]
-            else:
-                bundle = self.data_bundle[idx]
+            # Retrieve bundle sample
+            bundle = self.load_bundle(idx)
+
+            # Random sampling if training
+            if select_inds is not None:
+                fn = lambda x: batch_random_sampling(select_inds, x)
+                if self.cfg.dataset.use_ndc:
+                    # Use normalized device coordinates
+                    bundle = bundle.apply(fn, ["ray_origins", "ray_directions", "ray_targets", "target_depth", "target_normals"])
+                else:
+                    bundle = bundle.apply(fn, ["ray_directions", "ray_targets", "target_depth", "target_normals"])
 
-        # Random sampling if training
-        if self.type == DatasetType.TRAIN:
-            fn = lambda x: batch_random_sampling(self.cfg, self.coords, x)
+        # Sampled pixels, such that the training errors are fed back to the importance sampler
+        if isinstance(self.pixel_sampler, ImportancePixelSampler):
+            bundle.ray_images = torch.full_like(select_inds, idx)
+            bundle.ray_pixels = select_inds
+
+        return bundle.serialize(self.filters)
+
+    def load_bundle(self, idx):
+        if self.cfg.dataset.caching.use_caching and self.use_memmap:
+            return self.load_memmap_bundle(idx)
+
+        if self.cfg.dataset.caching.use_caching:
+            return DataBundle.deserialize(torch.load(self.paths[idx]))
+
+        if self.synthetic_bundle is not None:
+            return self.synthetic_bundle[idx]
+
+        return self.data_bundle[idx]
+
+    def init_global_sampling(self):
+        print("Flattening the rays of all the training images...")
+        rays = {"ray_directions": [], "ray_targets": [], "target_depth": [], "target_normals": []}
+        origins, images, bounds = [], [], []
+        for idx in trange(len(self)):
+            bundle = self.load_bundle(idx)
+
+            # Flatten the image dimensions
+            for name in rays.keys():
+                value = getattr(bundle, name)
+                if value is not None:
+                    rays[name].append(value.flatten(0, 1).cpu())
+
+            ray_count = rays["ray_directions"][-1].shape[0]
             if self.cfg.dataset.use_ndc:
-                # Use normalized device coordinates
-                bundle = bundle.apply(fn, ["ray_origins", "ray_directions", "ray_targets", "target_depth", "target_normals"])
+                # Origins per ray in normalized device coordinates
+                origins.append(bundle.ray_origins.flatten(0, 1).cpu())
             else:
-                bundle = bundle.apply(fn, ["ray_directions", "ray_targets", "target_depth", "target_normals"])
+                # Origins per image, referenced by the image index of each ray
+                origins.append(bundle.ray_origins.view(1, 3).cpu())
 
-        return bundle.serialize(self.filters)
+            # Bounds per image, referenced by the image index of each ray
+            bounds.append(bundle.ray_bounds.view(-1, 2)[:1].cpu())
+            images.append(torch.full((ray_count,), idx, dtype=torch.int))
+
+        self.global_rays = {name: torch.cat(values, 0) for name, values in rays.items() if len(values) > 0}
+        self.global_origins = torch.cat(origins, 0)
+        self.global_images = torch.cat(images, 0)
+        self.global_bounds = torch.cat(bounds, 0)
+
+    @property
+    def global_ray_count(self):
+        return self.global_rays["ray_directions"].shape[0]
+
+    def load_global_batch(self, indices):
+        images = self.global_images[indices].long()
+
+        # Bounds per ray, from the image of each ray
+        bundle = DataBundle(ray_bounds=self.global_bounds[images], size=len(self), hwf=self.hwf)
+        for name, value in self.global_rays.items():
+            setattr(bundle, name, value[indices])
+
+        if self.cfg.dataset.use_ndc:
+            bundle.ray_origins = self.global_origins[indices]
+        else:
+            bundle.ray_origins = self.global_origins[images]
+
+        return bundle
 
     def init_sampling(self, hwf):
         # Unpack data props
-        H, W, _ = hwf
+        self.hwf = hwf
+
+    def init_pixel_sampler(self):
+        self.pixel_sampler = create_pixel_sampler(self.cfg, self.hwf, len(self))
 
-        # Coordinates to sample from, list of H * W indices in form of (width, height), H * W * 2
-        self.coords = torch.stack(
-            meshgrid_xy(torch.arange(H), torch.arange(W)),
-            dim=-1,
-        ).reshape((-1, 2))
+        # Importance weights kept alongside the cached dataset
+        if isinstance(self.pixel_sampler, ImportancePixelSampler) and os.path.exists(self.sampling_weights_path):
+            print(f"Loading the sampling weights from {self.sampling_weights_path}...")
+            self.pixel_sampler.load_state_dict(torch.load(self.sampling_weights_path))
+
+    @property
+    def sampling_weights_path(self):
+        return os.path.join(self.path, "sampling_weights.pt")
+
+    def save_sampling_weights(self):
+        if isinstance(self.pixel_sampler, ImportancePixelSampler):
+            os.makedirs(self.path, exist_ok=True)
+            torch.save(self.pixel_sampler.state_dict(), self.sampling_weights_path)
 
     def save_dataset(self, bundle: DataBundle, img_idx, batch_idx=-1):
         """
@@ -261,6 +396,82 @@ class CachingDataset(SynthesizableDataset, Dataset):
         # serialize and save
         torch.save(bundle.to("cpu").serialize(self.filters), save_path)
 
+    @property
+    def memmap_path(self):
+        return os.path.join(self.path, "rays")
+
+    @property
+    def memmap_arrays(self):
+        # Mapped on first access, such that each data loader worker shares the page cache
+        if self._memmap_arrays is None:
+            self._memmap_arrays, self.memmap_meta = load_memmap_arrays(self.memmap_path)
+
+        return self._memmap_arrays
+
+    def cached_paths(self):
+        if self.use_memmap:
+            return glob.glob(f"{self.memmap_path}.json")
+
+        return glob.glob(os.path.join(self.path, "*.data"))
+
+    def create_memmap(self, sample: DataBundle, size):
+        # Targets in uint8 and directions, normals in float16, if compact
+        half = self.cfg.dataset.caching.get("half_precision", False)
+
+        layout = {}
+        for name in self.memmap_fields:
+            value = getattr(sample, name)
+            if value is None:
+                continue
+
+            dtype = "float32"
+            if half and name == "ray_targets":
+                dtype = "uint8"
+            elif half and name in ["ray_directions", "target_normals"]:
+                dtype = "float16"
+
+            layout[name] = ((size, *value.shape), dtype)
+
+        return create_memmap_arrays(self.memmap_path, layout, meta={
+            "hwf": [int(sample.hwf[0]), int(sample.hwf[1]), float(sample.hwf[2])],
+            "size": size
+        })
+
+    def save_memmap(self, arrays, sample: DataBundle, img_idx):
+        for name, array in arrays.items():
+            value = getattr(sample, name).cpu()
+            if array.dtype == np.uint8:
+                value = (value * 255.0).round().clamp(0, 255)
+
+            array[img_idx] = value.numpy().astype(array.dtype)
+
+    def load_memmap_bundle(self, idx, select_inds=None):
+        """ Reads an image bundle from the mapped arrays, only the rows of the selected pixels
+        if select_inds is given.
+        """
+        sampled_fields = ["ray_directions", "ray_targets", "target_depth", "target_normals"]
+        if self.cfg.dataset.use_ndc:
+            sampled_fields.append("ray_origins")
+
+        if select_inds is not None:
+            select_inds = select_inds.numpy()
+
+        bundle = DataBundle(size=self.memmap_meta["size"], hwf=self.hwf)
+        for name, array in self.memmap_arrays.items():
+            if select_inds is not None and name in sampled_fields:
+                # Linear pixel indices over the flattened image
+                value = array[idx].reshape(-1, *array.shape[3:])[select_inds]
+            else:
+                value = array[idx]
+
+            value = torch.from_numpy(np.array(value))
+            if value.dtype == torch.uint8:
+                value = value.float() / 255.0
+
+            setattr(bundle, name, value.float())
+
+        return bundle
+
     def cache_dataset(self):
         # TODO(0) testskip = args.blender_stride, offset for a small dataset
         # Unpacking data
@@ -269,6 +480,7 @@ class CachingDataset(SynthesizableDataset, Dataset):
         # Coordinates to sample from
         self.init_sampling(bundle.hwf)
 
+        arrays = None
         for img_idx in trange(bundle.size):
             # Create data chunk bundle
             sample = bundle[img_idx]
@@ -277,11 +489,23 @@ class CachingDataset(SynthesizableDataset, Dataset):
                 # Use normalized device coordinates
                 sample.ndc()
 
-            if self.cfg.dataset.caching.sample_all or self.type == DatasetType.VALIDATION:
-                self.save_dataset(sample, img_idx)
-            else:
+            if not self.cfg.dataset.caching.sample_all and self.type != DatasetType.VALIDATION:
                 raise NotImplementedError
 
+            if self.use_memmap:
+                if arrays is None:
+                    arrays = self.create_memmap(sample, bundle.size)
+
+                self.save_memmap(arrays, sample, img_idx)
+            else:
+                self.save_dataset(sample, img_idx)
+
+        if arrays is not None:
+            for array in arrays.values():
+                array.flush()
+
+            self._memmap_arrays = None
+
     @property
     def dataset_path(self):
         return Path(self.cfg.dataset.basedir)
@@ -0,0 +1,164 @@
+import math
+import torch
+
+from abc import abstractmethod
+
+
+class PixelSampler:
+    """ Draws the linear pixel indices (y * W + x) of a random ray batch from a single image.
+    """
+
+    def __init__(self, height, width, count):
+        self.height, self.width, self.count = height, width, count
+
+    @property
+    def pixel_count(self):
+        return self.height * self.width
+
+    @abstractmethod
+    def sample(self, image_idx):
+        pass
+
+
+class UniformPixelSampler(PixelSampler):
+
+    def sample(self, image_idx):
+        # Uniform with replacement
+        return torch.randint(self.pixel_count, (self.count,))
+
+
+class StratifiedPixelSampler(PixelSampler):
+    """ Spreads the samples evenly over square image tiles, uniformly within each tile.
+    """
+
+    def __init__(self, height, width, count, tile_size = 16):
+        super(StratifiedPixelSampler, self).__init__(height, width, count)
+        self.tile_size = tile_size
+        self.tiles_y = math.ceil(height / tile_size)
+        self.tiles_x = math.ceil(width / tile_size)
+
+    @property
+    def tile_count(self):
+        return self.tiles_y * self.tiles_x
+
+    def tiles_to_pixels(self, tiles):
+        # Tile corners, the border tiles are cropped to the image
+        y0 = (tiles // self.tiles_x) * self.tile_size
+        x0 = (tiles % self.tiles_x) * self.tile_size
+        tile_height = (self.height - y0).clamp(max = self.tile_size)
+        tile_width = (self.width - x0).clamp(max = self.tile_size)
+
+        # Uniform pixel within each tile
+        y = y0 + (torch.rand(tiles.shape[0]) * tile_height).long()
+        x = x0 + (torch.rand(tiles.shape[0]) * tile_width).long()
+
+        return y * self.width + x
+
+    def pixels_to_tiles(self, pixels):
+        y, x = pixels // self.width, pixels % self.width
+
+        return (y // self.tile_size) * self.tiles_x + x // self.tile_size
+
+    def sample(self, image_idx):
+        # Even share of the samples per tile, starting from a random tile
+        offset = torch.randint(self.tile_count, (1,))
+        tiles = (torch.arange(self.count) * self.tile_count // self.count + offset) % self.tile_count
+
+        return self.tiles_to_pixels(tiles)
+
+
+class ImportancePixelSampler(StratifiedPixelSampler):
+    """ Draws the tiles proportionally to the per image tile weights mixed with a uniform floor, then a uniform
+    pixel within each tile. With tile size 1 the weights are per pixel. The inverse CDF of an image is cached
+    until its weights change, such that a batch costs O(count log tiles). The weights track the recent
+    training error of each tile, starting from 1 such that the unvisited tiles are favoured.
+    """
+
+    def __init__(self, height, width, count, image_count, tile_size = 16, floor = 0.1, decay = 0.9):
+        super(ImportancePixelSampler, self).__init__(height, width, count, tile_size)
+        self.floor = floor
+        self.decay = decay
+        self.weights = torch.ones(image_count, self.tile_count)
+
+        # Pixel count of each tile, the weights are densities over the tile area
+        tiles = torch.arange(self.tile_count)
+        tile_height = (self.height - (tiles // self.tiles_x) * tile_size).clamp(max = tile_size)
+        tile_width = (self.width - (tiles % self.tiles_x) * tile_size).clamp(max = tile_size)
+        self.tile_areas = (tile_height * tile_width).float()
+
+        # Weights version per image, the cached CDF is rebuilt on change
+        self.versions = torch.zeros(image_count, dtype = torch.long)
+        self.cdf_cache = {}
+
+        # Updates from the training loop are visible within the data loader workers
+        self.weights.share_memory_()
+        self.versions.share_memory_()
+
+    def cdf(self, image_idx):
+        version = int(self.versions[image_idx])
+        if image_idx not in self.cdf_cache or self.cdf_cache[image_idx][0] != version:
+            weights = self.weights[image_idx].clamp(min = 0) * self.tile_areas
+            pdf = (1.0 - self.floor) * weights / weights.sum().clamp(min = 1e-10)
+            pdf = pdf + self.floor * self.tile_areas / self.pixel_count
+            self.cdf_cache[image_idx] = (version, torch.cumsum(pdf, dim = -1))
+
+        return self.cdf_cache[image_idx][1]
+
+    def set_weights(self, image_idx, weights):
+        self.weights[image_idx] = weights
+        self.versions[image_idx] += 1
+
+    def update(self, images, pixels, errors):
+        """ Moves the weights of the sampled tiles towards the mean error of their rays.
+        Args:
+            images (torch.Tensor): Tensor (R) of the image index of each ray.
+            pixels (torch.Tensor): Tensor (R) of the linear pixel index of each ray.
+            errors (torch.Tensor): Tensor (R) of the loss of each ray.
+        """
+        keys = images * self.tile_count + self.pixels_to_tiles(pixels)
+        keys, inverse = torch.unique(keys, return_inverse = True)
+
+        # Mean error per sampled tile
+        errors = torch.zeros(keys.shape[0]).index_add_(0, inverse, errors.float())
+        errors = errors / torch.bincount(inverse, minlength = keys.shape[0]).float()
+
+        # Exponential moving average of the tile errors
+        weights = self.weights.view(-1)
+        weights[keys] = self.decay * weights[keys] + (1.0 - self.decay) * errors
+        self.versions[torch.unique(images)] += 1
+
+    def sample(self, image_idx):
+        # Inverse transform sampling of the tiles
+        cdf = self.cdf(image_idx)
+        u = torch.rand(self.count) * cdf[-1]
+        tiles = torch.searchsorted(cdf, u).clamp(max = self.tile_count - 1)
+
+        return self.tiles_to_pixels(tiles)
+
+    def state_dict(self):
+        return {"weights": self.weights.clone()}
+
+    def load_state_dict(self, state_dict):
+        assert state_dict["weights"].shape == self.weights.shape, "Sampling weights do not match the dataset"
+        self.weights.copy_(state_dict["weights"])
+        self.versions += 1
+
+
+def create_pixel_sampler(cfg, hwf, image_count):
+    """ Pixel sampler of the training ray batches, selected by nerf.train.pixel_sampling. """
+    H, W, _ = hwf
+    train_cfg = cfg.nerf.train
+    count = train_cfg.num_random_rays
+
+    strategy = train_cfg.get("pixel_sampling", "uniform")
+    if strategy == "uniform":
+        return UniformPixelSampler(H, W, count)
+    elif strategy == "stratified":
+        return StratifiedPixelSampler(H, W, count, train_cfg.get("tile_size", 16))
+    elif strategy == "importance":
+        return ImportancePixelSampler(
+            H, W, count, image_count, train_cfg.get("tile_size", 16), train_cfg.get("importance_floor", 0.1),
+            train_cfg.get("importance_decay", 0.9)
+        )
+
+    raise NotImplementedError(f"Pixel sampling {strategy} not implemented!")
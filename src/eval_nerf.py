@@ -133,6 +133,14 @@ if __name__ == "__main__":
         "--synthesis-images", action="store_true", default=False,
         help="Synthesis new views 360° around the neural scene.",
     )
+    parser.add_argument(
+        "--baked", type=str, default=None,
+        help="Render from a baked grid path (see bake_nerf.py) instead of the model checkpoint.",
+    )
+    parser.add_argument(
+        "--baked-samples", type=int, default=192,
+        help="Number of depth samples per ray when rendering from a baked grid.",
+    )
     config_args = parser.parse_args()
 
     # Existent log path
@@ -142,9 +150,15 @@ if __name__ == "__main__":
     # Available device
     device = "cuda" if torch.cuda.is_available() else "cpu"
 
-    # Load model checkpoint
-    print(f"Loading model from {path_parser.checkpoint_path}")
-    model = getattr(models, cfg.experiment.model).load_from_checkpoint(path_parser.checkpoint_path)
+    if config_args.baked is not None:
+        # Load baked grid
+        print(f"Loading baked grid from {config_args.baked}")
+        model = models.BakedModel(cfg, config_args.baked, config_args.baked_samples)
+    else:
+        # Load model checkpoint
+        print(f"Loading model from {path_parser.checkpoint_path}")
+        model = getattr(models, cfg.experiment.model).load_from_checkpoint(path_parser.checkpoint_path)
+
     model = model.eval().to(device)
 
     with torch.no_grad():
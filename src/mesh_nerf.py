@@ -1,13 +1,20 @@
 import argparse
+import json
 import os
+import time
+import imageio
 import numpy as np
 import torch
 import models
 
-from importlib import import_module
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pytorch3d.structures import Meshes
 from skimage import measure
-from nerf.nerf_helpers import export_obj, batchify
+from tqdm import tqdm
+from nerf.nerf_helpers import batchify, log_transmittance
+from nerf.export import export_mesh, MESH_EXPORTERS, TEXTURED_MESH_FORMATS
+from nerf.decimation import decimate_levels, merge_duplicate_vertices
+from data.loaders.load_llff import load_llff_data
 from lightning_modules import PathParser
 
 
@@ -55,13 +62,18 @@ def extract_radiance(model, args, device, nums):
 
 def extract_iso_level(density, args):
     # Density boundaries
-    min_a, max_a, std_a = density.min(), density.max(), density.std()
+    return adaptive_iso_level(density.min(), density.max(), density.mean(), density.std(), args)
 
+
+def adaptive_iso_level(min_a, max_a, mean_a, std_a, args):
     # Adaptive iso level
     iso_value = min(max(args.iso_level, min_a + std_a), max_a - std_a)
-    print(f"Min density {min_a}, Max density: {max_a}, Mean density {density.mean()}")
+    print(f"Min density {min_a}, Max density: {max_a}, Mean density {mean_a}")
     print(f"Querying based on iso level: {iso_value}")
 
+    if not min_a < iso_value < max_a:
+        raise ValueError(f"The iso level {iso_value} is not crossed by the density range [{min_a}, {max_a}]!")
+
     return iso_value
 
 
@@ -75,96 +87,445 @@ def extract_geometry(model, device, args):
     # Adaptive iso level
     iso_value = extract_iso_level(density, args)
 
+    # Extracting iso-surface triangulated
+    vertices, triangles, normals = triangulate(density, iso_value, args.res, args.limit)
+
+    return vertices, triangles, normals, density
+
+
+def triangulate(density, iso_value, res, limit):
     # Extracting iso-surface triangulated
     results = measure.marching_cubes(density, iso_value)
 
     # Use contiguous tensors
     vertices, triangles, normals, _ = [torch.from_numpy(np.ascontiguousarray(result)) for result in results]
 
+    # Normalize vertices, to the (-limit, limit)
+    vertices = limit * (vertices / (res / 2.) - 1.)
+
+    return vertices, triangles, normals
+
+
+class IncrementalDensityGrid:
+    """ Dense density grid cached between the geometry evaluations of a training run. Each refresh queries a
+    coarse lattice first, every coarse_step-th point per axis, and re-queries at full resolution only the blocks
+    (and their neighbours) whose coarse occupancy changed since the previous refresh.
+    """
+
+    def __init__(self, res=128, limit=1.2, iso_level=32.0, block_size=16, coarse_step=4, batch_size=65536):
+        self.res, self.limit, self.iso_level = res, limit, iso_level
+        self.block_size, self.coarse_step, self.batch_size = block_size, coarse_step, batch_size
+        self.block_count = -(-res // block_size)
+
+        self.tiles = torch.linspace(-limit, limit, res)
+        self.density = None
+        self.coarse_occupancy = None
+
+    def query(self, model, device, indices):
+        # Density at the lattice points of the given (Nx3) indices
+        samples = self.tiles[indices]
+
+        density = []
+        for (samples,) in batchify(samples, batch_size=self.batch_size, device=device, progress=False):
+            density.append(model.sample_points(samples, samples)[..., 3].cpu())
+
+        return torch.cat(density, 0)
+
+    def block_indices(self, blocks):
+        # Lattice indices of all the points within the given (Bx3) blocks
+        offsets = torch.arange(self.block_size)
+        offsets = torch.stack(torch.meshgrid(offsets, offsets, offsets), -1).view(-1, 3)
+        indices = (blocks[:, None, :] * self.block_size + offsets[None]).reshape(-1, 3)
+
+        return indices[(indices < self.res).all(-1)]
+
+    @torch.no_grad()
+    def refresh(self, model, device):
+        """ Brings the cached grid up to date with the model.
+        Args:
+            model (torch.nn.Module): Model queried by sample_points.
+            device (torch.device): Device of the queries.
+        Returns:
+            density (np.ndarray): Dense density grid (res x res x res).
+            refreshed (float): Fraction of the blocks queried at full resolution.
+        """
+        # Coarse lattice, a subset of the full lattice
+        coarse = torch.arange(0, self.res, self.coarse_step)
+        coarse_indices = torch.stack(torch.meshgrid(coarse, coarse, coarse), -1).view(-1, 3)
+        coarse_density = self.query(model, device, coarse_indices)
+        coarse_occupancy = coarse_density > self.iso_level
+
+        if self.density is None:
+            self.density = torch.zeros(self.res, self.res, self.res)
+            dirty = torch.ones((self.block_count,) * 3, dtype=torch.bool)
+        else:
+            # Blocks with a changed coarse occupancy, dilated to their neighbours
+            changed = coarse_indices[coarse_occupancy != self.coarse_occupancy] // self.block_size
+            dirty = torch.zeros((self.block_count,) * 3)
+            dirty[changed[:, 0], changed[:, 1], changed[:, 2]] = 1.0
+            dirty = torch.nn.functional.max_pool3d(dirty[None, None], kernel_size=3, stride=1, padding=1)[0, 0] > 0
+
+        self.coarse_occupancy = coarse_occupancy
+
+        # Full resolution queries of the dirty blocks only
+        blocks = dirty.nonzero()
+        if blocks.shape[0] > 0:
+            indices = self.block_indices(blocks)
+            self.density[indices[:, 0], indices[:, 1], indices[:, 2]] = self.query(model, device, indices)
+
+        return self.density.numpy(), blocks.shape[0] / dirty.numel()
+
+    def extract_geometry(self, model, device):
+        """ Triangulated surface of the refreshed grid, None if the iso level is not crossed yet. """
+        start_time = time.time()
+        density, refreshed = self.refresh(model, device)
+
+        mesh = None
+        if density.min() < self.iso_level < density.max():
+            mesh = triangulate(density, self.iso_level, self.res, self.limit)
+
+        return mesh, refreshed, time.time() - start_time
+
+
+def query_lattices(model, device, tiles, lattices, batch_size):
+    # Density at the lattice points spanned by the per axis indices of each lattice, queried together
+    samples = [torch.stack(torch.meshgrid(*[tiles[index] for index in indices]), -1).view(-1, 3) for indices in lattices]
+    sizes = [lattice_samples.shape[0] for lattice_samples in samples]
+
+    density = []
+    for (samples,) in batchify(torch.cat(samples, 0), batch_size=batch_size, device=device, progress=False):
+        density.append(model.sample_points(samples, samples)[..., 3].cpu())
+
+    density = torch.cat(density, 0).split(sizes)
+
+    return [values.view(*[len(index) for index in indices]) for values, indices in zip(density, lattices)]
+
+
+def query_lattice(model, device, tiles, xs, ys, zs, batch_size):
+    # Density at the lattice points spanned by the per axis indices
+    return query_lattices(model, device, tiles, [(xs, ys, zs)], batch_size)[0]
+
+
+def extract_sparse_geometry(model, device, args):
+    """ Hierarchical extraction, the lattice of the block corners is queried first and only the blocks straddling
+    the iso level, dilated by a safety band of blocks, are refined to the full resolution. The lattices of several
+    blocks are gathered into each query of batch_size points, each refined block is triangulated on its own and the
+    vertices shared across the block faces are welded.
+    """
+    res, block_size = args.res, args.sparse_block_size
+    tiles = torch.linspace(-args.limit, args.limit, res)
+
+    # Coarse lattice of the block corners
+    corners = torch.arange(0, res - 1 + block_size, block_size).clamp(max=res - 1)
+    coarse = query_lattice(model, device, tiles, corners, corners, corners, args.batch_size)
+
+    # Adaptive iso level
+    iso_value = extract_iso_level(coarse.numpy(), args)
+
+    # Blocks whose corners straddle the iso level
+    coarse_grid = coarse[None, None]
+    cell_max = torch.nn.functional.max_pool3d(coarse_grid, kernel_size=2, stride=1)
+    cell_min = -torch.nn.functional.max_pool3d(-coarse_grid, kernel_size=2, stride=1)
+    active = ((cell_min < iso_value) & (cell_max > iso_value)).float()
+
+    band = args.sparse_band
+    active = torch.nn.functional.max_pool3d(active, kernel_size=2 * band + 1, stride=1, padding=band)[0, 0] > 0
+
+    blocks = active.nonzero()
+    print(f"Refining {blocks.shape[0]} out of {active.numel()} blocks")
+
+    # Block lattices including the shared faces with their neighbours
+    lattices = [[torch.arange(corners[b], corners[b + 1] + 1) for b in block] for block in blocks.tolist()]
+
+    vertices, triangles, normals = [], [], []
+    with tqdm(total=len(lattices)) as progress:
+        start = 0
+        while start < len(lattices):
+            # Consecutive blocks gathered until a batch is filled
+            end, size = start, 0
+            while end < len(lattices) and size < args.batch_size:
+                size += np.prod([len(index) for index in lattices[end]])
+                end += 1
+
+            densities = query_lattices(model, device, tiles, lattices[start:end], args.batch_size)
+            for indices, density in zip(lattices[start:end], densities):
+                density = density.numpy()
+                if not density.min() < iso_value < density.max():
+                    continue
+
+                block_vertices, block_triangles, block_normals, _ = measure.marching_cubes(density, iso_value)
+
+                vertices.append(block_vertices + np.array([index[0].item() for index in indices]))
+                triangles.append(block_triangles)
+                normals.append(block_normals)
+
+            progress.update(end - start)
+            start = end
+
+    vertices, triangles, normals = stitch_blocks(vertices, triangles, normals, res, args.limit)
+
+    return vertices, triangles, normals, coarse.numpy()
+
+
+def stitch_blocks(vertices, triangles, normals, res, limit):
+    """ Stitches the meshes triangulated per block, in lattice coordinates, by welding the duplicated vertices on
+    the shared block faces.
+    """
+    if len(vertices) == 0:
+        raise ValueError("None of the blocks crosses the iso level, the surface is empty!")
+
+    offsets = np.cumsum([0] + [block_vertices.shape[0] for block_vertices in vertices[:-1]])
+    triangles = [block_triangles + offset for block_triangles, offset in zip(triangles, offsets)]
+    vertices, triangles, normals = np.concatenate(vertices), np.concatenate(triangles), np.concatenate(normals)
+
+    # Weld the duplicated vertices on the block faces
+    keys = np.round(vertices * 1e3).astype(np.int64)
+    _, unique_index, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    vertices, normals = vertices[unique_index], normals[unique_index]
+    triangles = inverse.reshape(-1)[triangles]
+
+    # Drop the triangles collapsed by the welding
+    mask = (triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) & (triangles[:, 0] != triangles[:, 2])
+    triangles = triangles[mask]
+
     # Use contiguous tensors
-    normals = torch.from_numpy(np.ascontiguousarray(normals))
-    vertices = torch.from_numpy(np.ascontiguousarray(vertices))
-    triangles = torch.from_numpy(np.ascontiguousarray(triangles))
+    vertices, triangles, normals = [torch.from_numpy(np.ascontiguousarray(result)) for result in (vertices, triangles, normals)]
 
     # Normalize vertices, to the (-limit, limit)
-    vertices = args.limit * (vertices / (args.res / 2.) - 1.)
+    vertices = limit * (vertices / (res / 2.) - 1.)
 
-    return vertices, triangles, normals, density
+    return vertices, triangles, normals
 
 
-def extract_geometry_with_super_sampling(model, device, args):
-    raise NotImplementedError
-    try:
-        mcubes = import_module("marching_cubes")
-    except ModuleNotFoundError:
-        print("""
-            Run the following instructions within your environment:
-            https://github.com/JustusThies/PyMarchingCubes#installation
-        """)
+def extract_density_volume(model, device, args, path):
+    """ Queries the density lattice slab by slab into a memory-mapped (.npy) volume, such that the resolution is
+    bounded by the disk instead of the memory. The statistics for the adaptive iso level are accumulated on the fly.
+    """
+    res = args.res
+    tiles = torch.linspace(-args.limit, args.limit, res)
+    volume = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(res,) * 3)
+
+    min_a, max_a, total, total_squared = np.inf, -np.inf, 0.0, 0.0
+    for start in tqdm(range(0, res, args.volume_block_size)):
+        xs = torch.arange(start, min(start + args.volume_block_size, res))
+        density = query_lattice(model, device, tiles, xs, torch.arange(res), torch.arange(res), args.batch_size).numpy()
+        volume[xs[0]:xs[-1] + 1] = density
+
+        # Running statistics
+        min_a, max_a = min(min_a, density.min()), max(max_a, density.max())
+        total, total_squared = total + density.sum(dtype=np.float64), total_squared + (density.astype(np.float64) ** 2).sum()
+
+    volume.flush()
+
+    mean_a = total / volume.size
+    std_a = np.sqrt(max(total_squared / volume.size - mean_a ** 2, 0.0))
+
+    return volume, adaptive_iso_level(min_a, max_a, mean_a, std_a, args)
+
+
+def triangulate_block(path, start, end, iso_value):
+    """ Marching cubes over a block of the memory-mapped volume, the lattice points within [start, end] included,
+    such that the neighbouring blocks share one layer of points. Runs within the worker processes.
+    """
+    volume = np.load(path, mmap_mode="r")
+    density = np.ascontiguousarray(volume[start[0]:end[0] + 1, start[1]:end[1] + 1, start[2]:end[2] + 1])
+    if not density.min() < iso_value < density.max():
+        return None
+
+    vertices, triangles, normals, _ = measure.marching_cubes(density, iso_value)
 
-        # Close process
-        exit(-1)
+    return vertices + np.array(start), triangles, normals
 
-    # Sampling resolution per axis
-    nums = np.array([args.res + (args.res - 1) * args.super_sampling, args.res, args.res])
 
-    # Radiance per axis, super sampling across each axis
-    radiances = []
-    for i in range(0, 3):
-        # Roll such that each axis is rich
-        radiance_axis = extract_radiance(model, args, device, np.roll(nums, i))[..., 3]
+def extract_out_of_core_geometry(model, device, args):
+    """ Block-wise extraction through a memory-mapped density volume. The blocks are triangulated in parallel by a
+    process pool, each reading only its own part of the volume, and the block meshes are stitched together. The
+    volume stays on disk, no density grid is returned.
+    """
+    path = os.path.join(args.save_dir, args.volume_name)
+    _, iso_value = extract_density_volume(model, device, args, path)
 
-        radiances.append(radiance_axis)
+    # Blocks spanning the cells, the last lattice layer of each is shared with the next one
+    res, block_size = args.res, args.volume_block_size
+    starts = range(0, res - 1, block_size)
+    blocks = [
+        ((x, y, z), (min(x + block_size, res - 1), min(y + block_size, res - 1), min(z + block_size, res - 1)))
+        for x in starts for y in starts for z in starts
+    ]
 
-    # accumulate
-    density = np.stack(radiances, axis=0)
+    workers = args.volume_workers if args.volume_workers > 0 else os.cpu_count()
+    print(f"Triangulating {len(blocks)} blocks with {workers} workers")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(triangulate_block, path, start, end, iso_value) for start, end in blocks]
+        results = [future.result() for future in tqdm(futures)]
+
+    results = [result for result in results if result is not None]
+    vertices, triangles, normals = [[result[i] for result in results] for i in range(3)]
+    vertices, triangles, normals = stitch_blocks(vertices, triangles, normals, res, args.limit)
+
+    return vertices, triangles, normals, None
+
+
+def extract_geometry_with_super_sampling(model, device, args):
+    """ Marching cubes with the vertices placed by super sampling. Each vertex lies on a lattice edge crossing the
+    iso level, only these edges are sampled at super_sampling extra points and each vertex is moved to the nearest
+    iso level crossing of the finer samples.
+    """
+    # Sample points based on the grid
+    radiance = extract_radiance(model, args, device, args.res)
+
+    # Density grid
+    density = radiance[..., 3]
 
     # Adaptive iso level
     iso_value = extract_iso_level(density, args)
 
-    vertices, triangles = mcubes.marching_cubes_super_sampling(*radiances, iso_value)
+    # Extracting iso-surface triangulated, the vertices are in lattice coordinates
+    results = measure.marching_cubes(density, iso_value)
+    vertices, triangles, normals, _ = [torch.from_numpy(np.ascontiguousarray(result)) for result in results]
 
-    vertices = np.ascontiguousarray(vertices)
-    mcubes.export_obj(vertices, triangles, os.path.join(args.save_dir, "mesh.obj"))
+    # Lattice edge of each vertex, along its fractional axis
+    vertices = vertices.float()
+    edge_start = vertices.floor()
+    edge_offset = vertices - edge_start
+    edge_offset, edge_axis = edge_offset.max(-1)
+    edge_direction = torch.nn.functional.one_hot(edge_axis, 3).float()
 
+    # Super samples along each edge, including the end points
+    t_vals = torch.linspace(0.0, 1.0, args.super_sampling + 2)
+    samples = edge_start[:, None, :] + t_vals[None, :, None] * edge_direction[:, None, :]
+    samples = -args.limit + samples.view(-1, 3) * (2.0 * args.limit / (args.res - 1))
 
-def export_marching_cubes(model, args, cfg, device):
-    # Mesh Extraction
+    edge_density = []
+    for (samples,) in batchify(samples, batch_size=args.batch_size, device=device):
+        edge_density.append(model.sample_points(samples, samples)[..., 3].cpu())
 
-    if args.super_sampling >= 1:
-        print("Generating mesh geometry...")
+    edge_density = torch.cat(edge_density, 0).view(vertices.shape[0], -1)
 
-        # Extract model geometry with super sampling across each axis
-        extract_geometry_with_super_sampling(model, device, args)
-        return
+    # Iso level crossings between consecutive super samples
+    d0, d1 = edge_density[:, :-1], edge_density[:, 1:]
+    crossing = (d0 > iso_value) != (d1 > iso_value)
+    denom = torch.where(crossing, d1 - d0, torch.ones_like(d0))
+    t_crossing = t_vals[:-1] + (iso_value - d0) / denom * (t_vals[1] - t_vals[0])
 
-    # Cached mesh path containing data
-    mesh_cache_path = os.path.join(args.save_dir, args.cache_name)
+    # Nearest crossing to the base vertex, the vertices on the lattice points are kept
+    distance = torch.where(crossing, (t_crossing - edge_offset[:, None]).abs(), torch.full_like(t_crossing, np.inf))
+    distance, nearest = distance.min(-1)
+    mask = torch.isfinite(distance) & (edge_offset > 0)
 
-    cached_mesh_exists = os.path.exists(mesh_cache_path)
-    cache_new_mesh = args.use_cached_mesh and not cached_mesh_exists
-    if cache_new_mesh:
-        print(f"Cached mesh does not exist - {mesh_cache_path}")
+    t_nearest = t_crossing.gather(-1, nearest[:, None])
+    vertices[mask] = (edge_start + t_nearest * edge_direction)[mask]
 
-    if args.use_cached_mesh and cached_mesh_exists:
-        print("Loading cached mesh geometry...")
-        vertices, triangles, normals, density = torch.load(mesh_cache_path)
+    # Normalize vertices, to the (-limit, limit)
+    vertices = args.limit * (vertices / (args.res / 2.) - 1.)
+
+    return vertices, triangles, normals, density
+
+
+def load_camera_origins(cfg):
+    """ Camera centres of the training views, the blender poses are read without loading the images. """
+    if cfg.dataset.type == "blender":
+        with open(os.path.join(cfg.dataset.basedir, "transforms_train.json"), "r") as fh:
+            frames = json.load(fh)["frames"]
+
+        origins = np.stack([np.array(frame["transform_matrix"])[:3, 3] for frame in frames])
+    elif cfg.dataset.type == "colmap":
+        _, poses, _, _, _ = load_llff_data(
+            cfg.dataset.basedir, factor=cfg.dataset.llff_downsample_factor, spherify=True
+        )
+        origins = poses[:, :3, 3]
     else:
-        print("Generating mesh geometry...")
-        # Extract model geometry
-        vertices, triangles, normals, density = extract_geometry(model, device, args)
+        raise NotImplementedError(f"Camera poses of the {cfg.dataset.type} dataset not implemented!")
 
-        if cache_new_mesh or args.override_cache_mesh:
-            torch.save((vertices, triangles, normals, density), mesh_cache_path)
-            print(f"Cached mesh geometry saved to {mesh_cache_path}")
+    return torch.from_numpy(origins).float()
+
+
+def select_views(vertices, normals, camera_origins, view_count):
+    """ The cameras facing each vertex the most, blended by the cosine between the normal and the view.
+    Args:
+        vertices (torch.Tensor): Tensor (Nx3) of the vertices.
+        normals (torch.Tensor): Tensor (Nx3) of the outward vertex normals.
+        camera_origins (torch.Tensor): Tensor (Cx3) of the camera centres.
+        view_count (int): Max views per vertex.
+    Returns:
+        view_directions (torch.Tensor): Tensor (NxKx3) of the directions from the cameras towards the vertices.
+        view_weights (torch.Tensor): Tensor (NxK) of the normalized blending weights.
+    """
+    directions = camera_origins[None, :, :] - vertices[:, None, :]
+    directions = directions / directions.norm(dim=-1, keepdim=True).clamp(min=1e-10)
+
+    cosine = (directions * normals[:, None, :]).sum(dim=-1)
+    cosine, indices = cosine.topk(min(view_count, camera_origins.shape[0]), dim=-1)
+
+    # Views from behind the surface do not contribute, unless none faces the vertex
+    view_weights = cosine.clamp(min=0) + 1e-6
+    view_weights = view_weights / view_weights.sum(dim=-1, keepdim=True)
+    view_directions = -directions.gather(1, indices[..., None].expand(-1, -1, 3))
 
-    # Extracting the mesh appearance
+    return view_directions, view_weights
 
+
+def bake_appearance_chunk(model, vertices, normals, camera_origins, args, device):
+    # Gradient mode is thread local
+    with torch.no_grad():
+        vertices, normals = vertices.float().to(device), normals.float().to(device)
+        view_directions, view_weights = select_views(vertices, normals, camera_origins, args.appearance_views)
+
+        # Samples within a short band across the surface along the inverse normal, shared by all the views
+        band = args.appearance_band
+        depth_values = torch.linspace(-band, band, args.appearance_samples, device=device)
+        ray_points = vertices[:, None, :] - depth_values[None, :, None] * normals[:, None, :]
+
+        # Radiance field (N, K, S, 4), the density does not depend on the view
+        radiance_field = model.sample_views(ray_points, view_directions).float()
+        sigma_delta = torch.nn.functional.relu(radiance_field[:, 0, :, 3]) * (2 * band / max(args.appearance_samples - 1, 1))
+
+        # Compositing weights normalized over the band, uniform without any density
+        _, _, weights = log_transmittance(sigma_delta, sigma_delta.new_zeros(sigma_delta.shape[0]))
+        weights = weights + 1e-10
+        weights = weights / weights.sum(dim=-1, keepdim=True)
+
+        # Surface colour per view, blended across the views
+        rgb = (weights[:, None, :, None] * radiance_field[..., :3]).sum(dim=-2)
+        rgb = (view_weights[..., None] * rgb).sum(dim=-2)
+
+        return rgb.cpu()
+
+
+def bake_appearance(model, vertices, normals, camera_origins, args, device):
+    """ Vertex colours blended from the nearest training views, the chunks are rendered on a thread pool such
+    that the host side view selection and transfers overlap with the device queries.
+    """
+    camera_origins = camera_origins.to(device)
+
+    def bake_chunk(start):
+        tn_slice = slice(start, start + args.batch_size)
+        return bake_appearance_chunk(model, vertices[tn_slice], normals[tn_slice], camera_origins, args, device)
+
+    starts = range(0, vertices.shape[0], args.batch_size)
+    with ThreadPoolExecutor(max_workers=args.appearance_workers) as executor:
+        return list(tqdm(executor.map(bake_chunk, starts), total=len(starts)))
+
+
+def query_appearance(model, targets, normals, args, cfg, device):
+    """ Diffuse colour at the surface targets, seen against their outward normals.
+    Args:
+        model (torch.nn.Module): Model queried by sample_points, sample_views or query.
+        targets (torch.Tensor): Tensor (Nx3) of the surface points.
+        normals (torch.Tensor): Tensor (Nx3) of the outward normals.
+    Returns:
+        diffuse (np.ndarray): Array (Nx3) of the colours.
+    """
     # Ray targets and directions
-    targets, directions = vertices, -normals
+    directions = -normals
 
     diffuse = []
-    if args.no_view_dependence:
+    if args.appearance_views > 0:
+        print(f"Diffuse map baked from up to {args.appearance_views} training views per target...")
+        camera_origins = load_camera_origins(cfg)
+        diffuse = bake_appearance(model, targets, normals, camera_origins, args, device)
+    elif args.no_view_dependence:
         print("Diffuse map query directly  without specific-views...")
         # Query directly without specific-views
         batch_generator = batchify(targets, directions, batch_size=args.batch_size, device=device)
@@ -192,13 +553,188 @@ def export_marching_cubes(model, args, cfg, device):
             diffuse.append(output_bundle.rgb_map.cpu())
 
     # Query the whole diffuse map
-    diffuse = torch.cat(diffuse, dim=0).numpy()
+    return torch.cat(diffuse, dim=0).numpy()
+
+
+def unwrap_triangles(triangle_count, texture_size, margin=1):
+    """ Texture atlas of charts per triangle, packed in pairs into the square cells of a regular grid. The first
+    triangle of a cell covers its top left half, the second one its point reflection, with a gutter in between.
+    Args:
+        triangle_count (int): Triangle count.
+        texture_size (int): Texture width and height in texels.
+        margin (int): Gutter in texels around each chart.
+    Returns:
+        uvs (torch.Tensor): Tensor (3Fx2) of the texture coordinates per triangle corner, with the origin at the
+            bottom left corner.
+        grid_size (int): Cells per axis.
+        cell_size (int): Cell width and height in texels.
+    """
+    cell_count = (triangle_count + 1) // 2
+    grid_size = max(int(np.ceil(np.sqrt(cell_count))), 1)
+    cell_size = texture_size // grid_size
+    assert cell_size > 3 * margin, f"Texture size {texture_size} is too small for {triangle_count} triangles, " \
+        "increase it or decimate the mesh"
+
+    # Chart corners within a cell, (x, y) in texels with the origin at the top left corner
+    corners = torch.tensor([[margin, margin], [cell_size - 2 * margin, margin], [margin, cell_size - 2 * margin]])
+    corners = torch.stack((corners, cell_size - corners), 0).float()
+
+    # Cell origins of each triangle
+    cells = torch.arange(triangle_count) // 2
+    origins = torch.stack((cells % grid_size, cells // grid_size), -1).float() * cell_size
+    uvs = (origins[:, None, :] + corners[torch.arange(triangle_count) % 2]) / texture_size
+
+    # Bottom left origin
+    uvs[..., 1] = 1.0 - uvs[..., 1]
+
+    return uvs.view(-1, 2), grid_size, cell_size
+
+
+def rasterize_atlas(vertices, triangles, normals, texture_size, grid_size, cell_size, margin=1):
+    """ Surface points behind every texel of the used cells of the atlas laid out by unwrap_triangles. The
+    texels in the gutters are clamped onto the nearest chart, which pads the charts against filtering seams.
+    Returns:
+        texels (torch.Tensor): Tensor (P) of the linear texel indices.
+        targets (torch.Tensor): Tensor (Px3) of the surface points.
+        target_normals (torch.Tensor): Tensor (Px3) of the interpolated normals.
+    """
+    triangles = triangles.long()
+    triangle_count = triangles.shape[0]
+
+    # Texel centres within a cell, either in the first chart or reflected onto it
+    offsets = torch.arange(cell_size).float() + 0.5
+    y, x = torch.meshgrid(offsets, offsets)
+    second = (x + y) >= cell_size
+    x, y = torch.where(second, cell_size - x, x), torch.where(second, cell_size - y, y)
+
+    # Barycentric coordinates within the right angled chart, clamped onto it
+    length = cell_size - 3 * margin
+    u, v = ((x - margin) / length).clamp(min=0), ((y - margin) / length).clamp(min=0)
+    scale = (u + v).clamp(min=1)
+    u, v = u / scale, v / scale
+    barycentric = torch.stack((1 - u - v, u, v), -1).view(-1, 3)
+
+    # Triangle behind each texel of the used cells
+    cell_count = (triangle_count + 1) // 2
+    faces = (torch.arange(cell_count)[:, None] * 2 + second.view(1, -1)).view(-1)
+    barycentric = barycentric.repeat(cell_count, 1)
+
+    # Cells with a single triangle keep their second half empty
+    mask = faces < triangle_count
+    faces, barycentric = faces[mask], barycentric[mask]
+
+    # Linear texel indices
+    cells = faces // 2
+    local = torch.arange(cell_size * cell_size).repeat(cell_count)[mask]
+    rows = (cells // grid_size) * cell_size + local // cell_size
+    cols = (cells % grid_size) * cell_size + local % cell_size
+    texels = rows * texture_size + cols
+
+    # Interpolated surface points and normals
+    corners = triangles[faces]
+    targets = (barycentric[..., None] * vertices[corners].float()).sum(dim=-2)
+    target_normals = (barycentric[..., None] * normals[corners].float()).sum(dim=-2)
+    target_normals = target_normals / target_normals.norm(dim=-1, keepdim=True).clamp(min=1e-10)
+
+    return texels, targets, target_normals
+
+
+def bake_texture(model, vertices, triangles, normals, args, cfg, device):
+    """ Bakes the appearance into a texture atlas, all the texels are queried in a single bulk pass.
+    Returns:
+        uvs (torch.Tensor): Tensor (3Fx2) of the texture coordinates per triangle corner.
+        texture (np.ndarray): Array (TxTx3) of the texture.
+    """
+    uvs, grid_size, cell_size = unwrap_triangles(triangles.shape[0], args.texture_size)
+    texels, targets, target_normals = rasterize_atlas(
+        vertices, triangles, normals, args.texture_size, grid_size, cell_size
+    )
+    print(f"Atlas of {grid_size}x{grid_size} cells of {cell_size} texels, querying {texels.shape[0]} texels")
+
+    # Unused texels are left black
+    texture = np.zeros((args.texture_size * args.texture_size, 3), dtype=np.float32)
+    texture[texels.numpy()] = query_appearance(model, targets, target_normals, args, cfg, device)
+
+    return uvs, texture.reshape(args.texture_size, args.texture_size, 3)
+
+
+def decimate_mesh(vertices, triangles, normals, mesh_path, args):
+    """ Levels of detail decimated from the welded iso-surface, suffixed by their index when there are several.
+    Returns:
+        levels (list): Tuples (vertices, triangles, normals, mesh_path) from the finest level.
+    """
+    vertices, triangles, normals = merge_duplicate_vertices(
+        vertices.double().numpy(), triangles.long().numpy(), normals.double().numpy(), args.weld_tolerance
+    )
+    print(f"Welded mesh of {triangles.shape[0]} triangles with {vertices.shape[0]} vertices")
+
+    levels = decimate_levels(vertices, triangles, normals, args.decimate_triangles)
+
+    name, extension = os.path.splitext(mesh_path)
+    return [
+        (torch.from_numpy(v).float(), torch.from_numpy(f), torch.from_numpy(n).float(),
+         mesh_path if len(levels) == 1 else f"{name}_lod{i}{extension}")
+        for i, (v, f, n) in enumerate(levels)
+    ]
+
+
+def export_marching_cubes(model, args, cfg, device):
+    # Mesh Extraction
+
+    # Cached mesh path containing data
+    mesh_cache_path = os.path.join(args.save_dir, args.cache_name)
+
+    cached_mesh_exists = os.path.exists(mesh_cache_path)
+    cache_new_mesh = args.use_cached_mesh and not cached_mesh_exists
+    if cache_new_mesh:
+        print(f"Cached mesh does not exist - {mesh_cache_path}")
+
+    if args.use_cached_mesh and cached_mesh_exists:
+        print("Loading cached mesh geometry...")
+        vertices, triangles, normals, density = torch.load(mesh_cache_path)
+    else:
+        print("Generating mesh geometry...")
+        # Extract model geometry, either super sampled, hierarchically refined around the surface, out-of-core or dense
+        if args.super_sampling >= 1:
+            # Vertices placed by super sampling along the surface edges
+            vertices, triangles, normals, density = extract_geometry_with_super_sampling(model, device, args)
+        elif args.sparse_block_size > 0:
+            vertices, triangles, normals, density = extract_sparse_geometry(model, device, args)
+        elif args.volume_block_size > 0:
+            # Density volume on disk, triangulated block-wise across the processes
+            vertices, triangles, normals, density = extract_out_of_core_geometry(model, device, args)
+        else:
+            vertices, triangles, normals, density = extract_geometry(model, device, args)
+
+        if cache_new_mesh or args.override_cache_mesh:
+            torch.save((vertices, triangles, normals, density), mesh_cache_path)
+            print(f"Cached mesh geometry saved to {mesh_cache_path}")
 
     # Target mesh path
     mesh_path = os.path.join(args.save_dir, args.mesh_name)
 
-    # Export model
-    export_obj(vertices, triangles, diffuse, normals, mesh_path)
+    # Mesh levels, either the raw iso-surface or its decimated levels of detail
+    levels = [(vertices, triangles, normals, mesh_path)]
+    if args.decimate_triangles is not None:
+        levels = decimate_mesh(vertices, triangles, normals, mesh_path, args)
+
+    # Extracting the mesh appearance, only on the vertices of each exported level
+    for vertices, triangles, normals, mesh_path in levels:
+        if args.texture_size > 0:
+            print(f"Baking a texture atlas of size {args.texture_size}...")
+            uvs, texture = bake_texture(model, vertices, triangles, normals, args, cfg, device)
+
+            # Texture next to the mesh
+            texture_path = os.path.splitext(mesh_path)[0] + ".png"
+            imageio.imwrite(texture_path, (texture * 255.0).round().astype(np.uint8))
+
+            # Export model
+            export_mesh(vertices, triangles, None, normals, mesh_path, uvs, texture_path)
+        else:
+            diffuse = query_appearance(model, vertices, normals, args, cfg, device)
+
+            # Export model
+            export_mesh(vertices, triangles, diffuse, normals, mesh_path)
 
 
 if __name__ == "__main__":
@@ -217,7 +753,7 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--mesh-name", type=str, default="mesh.obj",
-        help="Mesh name to be generated.",
+        help="Mesh name to be generated, the format follows the extension, either (.obj), (.ply) or (.glb).",
     )
     parser.add_argument(
         "--iso-level", type=float, default=32,
@@ -231,9 +767,38 @@ if __name__ == "__main__":
         "--res", type=int, default=128,
         help="Sampling resolution for marching cubes, increase it for higher level of detail.",
     )
+    parser.add_argument(
+        "--sparse-block-size", type=int, default=0,
+        help="Hierarchical extraction, only the blocks of this size around the iso level are refined (0 for dense).",
+    )
+    parser.add_argument(
+        "--sparse-band", type=int, default=1,
+        help="Safety band in blocks around the coarse cells straddling the iso level.",
+    )
+    parser.add_argument(
+        "--volume-block-size", type=int, default=0,
+        help="Out-of-core extraction, the density volume is stored on disk and triangulated in blocks of this size "
+             "(0 for in memory).",
+    )
+    parser.add_argument(
+        "--volume-workers", type=int, default=0,
+        help="Processes triangulating the blocks of the out-of-core volume (0 for all the cores).",
+    )
+    parser.add_argument(
+        "--volume-name", type=str, default="density.npy",
+        help="Memory-mapped density volume name of the out-of-core extraction.",
+    )
     parser.add_argument(
         "--super-sampling", type=int, default=0,
-        help="Add super sampling along the edges.",
+        help="Extra samples along each surface crossing edge to place the vertices more precisely.",
+    )
+    parser.add_argument(
+        "--decimate-triangles", type=int, nargs="+", default=None,
+        help="Target triangle counts of the decimated levels of detail, each one exported (disabled by default).",
+    )
+    parser.add_argument(
+        "--weld-tolerance", type=float, default=1e-6,
+        help="Distance under which the duplicate vertices are merged before the decimation.",
     )
     parser.add_argument(
         "--batch-size", type=int, default=1024,
@@ -252,6 +817,26 @@ if __name__ == "__main__":
         help="Far max possible bound, usually set to (cfg.far - cfg.near), lower it for better "
              "appearance estimation when using higher resolution e.g. at least view_disparity * 2.0.",
     )
+    parser.add_argument(
+        "--appearance-views", type=int, default=0,
+        help="Bake the appearance from this many training views per vertex (0 for a single ray along the normal).",
+    )
+    parser.add_argument(
+        "--appearance-band", type=float, default=2e-2,
+        help="Half width of the band across the surface sampled for the baked appearance.",
+    )
+    parser.add_argument(
+        "--appearance-samples", type=int, default=16,
+        help="Samples within the band across the surface, shared by all the views.",
+    )
+    parser.add_argument(
+        "--appearance-workers", type=int, default=2,
+        help="Threads baking the appearance chunks concurrently.",
+    )
+    parser.add_argument(
+        "--texture-size", type=int, default=0,
+        help="Bake the appearance into a texture atlas of this size instead of the vertex colours (0 to disable).",
+    )
     parser.add_argument(
         "--use-cached-mesh", action="store_true", default=False,
         help="Use the cached mesh.",
@@ -266,6 +851,14 @@ if __name__ == "__main__":
     )
     config_args = parser.parse_args()
 
+    # Mesh format checked up front, before any extraction or baking
+    extension = os.path.splitext(config_args.mesh_name)[1].lower()
+    if extension not in MESH_EXPORTERS:
+        parser.error(f"Mesh format {extension} not implemented!")
+    if config_args.texture_size > 0 and extension not in TEXTURED_MESH_FORMATS:
+        formats = " or ".join(TEXTURED_MESH_FORMATS)
+        parser.error(f"Textured meshes are not implemented for the ({extension}) format, use {formats}!")
+
     # Existent log path
     path_parser = PathParser()
     cfg, _ = path_parser.parse(None, config_args.log_checkpoint, None, config_args.checkpoint)
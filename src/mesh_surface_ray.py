@@ -3,7 +3,6 @@ import numpy as np
 import torch
 import yaml
 
-from plyfile import PlyData, PlyElement
 from tqdm import tqdm
 
 from nerf import (
@@ -14,48 +13,7 @@ from nerf import (
     get_embedding_function,
     run_one_iter_of_nerf,
 )
-
-
-def export_obj(vertices, triangles, diffuse, normals, filename):
-    """
-    Exports a mesh in the (.obj) format.
-    """
-    print('Writing to obj')
-
-    with open(filename, 'w') as fh:
-
-        print(f"Total vertices {len(vertices)}")
-        for index, v in enumerate(vertices):
-            fh.write("vn {} {} {}".format(*normals[index]))
-            fh.write("\n")
-
-            fh.write("v {} {} {}".format(*v))
-            if len(diffuse) > index:
-                fh.write(" {} {} {}".format(*diffuse[index]))
-
-            fh.write("\n")
-
-        for f in triangles:
-            fh.write("f")
-            for index in f:
-                fh.write(" {}//{}".format(index + 1, index + 1))
-
-            fh.write("\n")
-
-
-def export_ply(vertices, diffuse, normals, filename):
-    names = 'x, y, z, nx, ny, nz, red, green, blue'
-    formats = 'f4, f4, f4, f4, f4, f4, u1, u1, u1'
-    arr = np.concatenate((vertices, normals, diffuse * 255), axis = -1)
-    vertices_s = np.core.records.fromarrays(arr.transpose(), names = names, formats = formats)
-
-    # Recreate the PlyElement instance
-    v = PlyElement.describe(vertices_s, 'vertex')
-
-    # Create the PlyData instance
-    p = PlyData([ v ], text = True)
-
-    p.write(filename)
+from nerf.export import export_obj, export_ply
 
 
 def get_grid(size):
@@ -151,7 +109,7 @@ def export_ray_trace(model_coarse, model_fine, config_args, cfg, encode_position
 
     # Export model
     # export_obj(vertices_fine, [], diffuse_fine, normals_fine, "lego-sampling.obj")
-    export_ply(vertices_fine, diffuse_fine, normals_fine, "lego-sampling.ply")
+    export_ply(vertices_fine, [], diffuse_fine, normals_fine, "lego-sampling.ply")
 
 
 def main():
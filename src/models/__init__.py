@@ -1,4 +1,5 @@
 from .model_base import *
 from .model_buff import BuFFModel
 from .model_nerf import NeRFModel
+from .model_baked import BakedModel
 from .model_helpers import *
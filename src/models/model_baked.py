@@ -0,0 +1,53 @@
+import torch
+
+from models.model_helpers import intervals_to_ray_points
+from nerf import BakedRadianceField, RaySampleInterval, VolumeRenderer
+
+
+class BakedModel(torch.nn.Module):
+    """ Renders a baked radiance grid (see bake_nerf.py) by trilinear lookup instead of the MLPs, exposing the
+    same query interface as the trained models for fast previews.
+    """
+
+    def __init__(self, cfg, path, num_samples = 192):
+        super(BakedModel, self).__init__()
+        self.cfg = cfg
+
+        # Baked grid
+        self.model = BakedRadianceField.load(path)
+
+        # Custom modules
+        self.sampler = RaySampleInterval(num_samples)
+        self.volume_renderer = VolumeRenderer(
+            0.0,
+            0.0,
+            self.cfg.dataset.white_background,
+            attenuation_threshold=1e-5
+        )
+
+    def get_model(self):
+        return self.model
+
+    def sample_points(self, points, rays=None, **kwargs):
+        return self.model(points, rays)
+
+    def query(self, ray_batch):
+        ray_origins, ray_directions, ray_bounds = ray_batch
+        near, far = ray_bounds[..., 0], ray_bounds[..., 1]
+
+        # Generating depth samples
+        ray_count = ray_directions.shape[0]
+        ray_intervals = self.sampler(self.cfg.nerf.validation, ray_count, near, far)
+
+        # Samples across each ray (num_rays, samples_count, 3)
+        ray_points = intervals_to_ray_points(ray_intervals, ray_directions, ray_origins)
+
+        # Grid lookup with early ray termination, if enabled
+        segment_size = self.cfg.nerf.validation.get("segment_size", 0)
+        if segment_size > 0:
+            return self.volume_renderer.march(self.model, ray_points, ray_intervals, ray_directions, segment_size)
+
+        # Grid lookup
+        radiance_field = self.model(ray_points, ray_directions)
+
+        return self.volume_renderer(radiance_field, ray_intervals, ray_directions)
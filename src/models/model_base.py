@@ -5,12 +5,14 @@ import pytorch_lightning as pl
 from pytorch3d.ops import sample_points_from_meshes
 from pytorch3d.loss import chamfer_distance
 from torch.utils.tensorboard import SummaryWriter
-from mesh_nerf import extract_geometry, create_mesh
+from mesh_nerf import IncrementalDensityGrid, create_mesh
 from torch.optim.lr_scheduler import LambdaLR
 from abc import abstractmethod
 from torch.utils.data import DataLoader
-from data.datasets import BlenderDataset, ColmapDataset, DatasetType, SynthesizableDataset
-from nerf import CfgNode, mse2psnr, VolumeRenderer
+from typing import Dict, Any
+from data.samplers import ImportancePixelSampler
+from data.datasets import BlenderDataset, ColmapDataset, DatasetType, SynthesizableDataset, RayBatchSampler
+from nerf import CfgNode, mse2psnr, autocast, cast_to_image, VolumeRenderer
 from models.model_helpers import nest_dict, flatten_dict
 
 
@@ -35,6 +37,12 @@ class BaseModel(pl.LightningModule):
         # Dataset types
         self.train_dataset, self.val_dataset = None, None
 
+        # Importance sampling weights restored from a checkpoint
+        self.sampling_weights = None
+
+        # Density grid cached between the chamfer evaluations
+        self.density_grid = None
+
     @abstractmethod
     def get_model(self):
         pass
@@ -62,6 +70,71 @@ class BaseModel(pl.LightningModule):
     def query(self, ray_batch):
         pass
 
+    @abstractmethod
+    def render_outputs(self, ray_batch):
+        pass
+
+    def render_validation(self, bundle):
+        """ Renders a batch of validation views into preallocated images. The rays of all the views are streamed
+        through the model in chunks, such that several views share each batched forward pass.
+        Args:
+            bundle (DataBundle): Batch of validation views, optionally rendered at a strided resolution.
+        Returns:
+            images (dict): Tensors (NxHxWx3) of the rendered views per output name.
+            targets (torch.Tensor): Tensor (NxHxWx3) of the target views.
+        """
+        stride = self.cfg.nerf.validation.get("downsample", 1)
+        ray_directions = bundle.ray_directions[:, ::stride, ::stride]
+        targets = bundle.ray_targets[:, ::stride, ::stride]
+        view_count, height, width = ray_directions.shape[:3]
+
+        # Origins per ray, either in normalized device coordinates or shared across each view
+        if bundle.ray_origins.dim() == 2:
+            ray_origins = bundle.ray_origins[:, None, None, :].expand_as(ray_directions)
+        else:
+            ray_origins = bundle.ray_origins[:, ::stride, ::stride]
+
+        ray_origins, ray_directions = ray_origins.reshape(-1, 3), ray_directions.reshape(-1, 3)
+
+        # Bounds per ray, repeated from the bounds of each view
+        ray_bounds = bundle.ray_bounds.view(-1, 2)
+        if ray_bounds.shape[0] == 1:
+            ray_bounds = ray_bounds.expand(view_count, 2)
+        else:
+            ray_bounds = ray_bounds.view(view_count, -1, 2)[:, 0]
+        ray_bounds = ray_bounds[:, None, :].expand(-1, height * width, -1).reshape(-1, 2)
+
+        images = {}
+        batch_size = self.cfg.nerf.validation.chunksize
+        for i in range(0, ray_directions.shape[0], batch_size):
+            tn_slice = slice(i, i + batch_size)
+
+            # Chunk outputs streamed into the image buffers
+            outputs = self.render_outputs((ray_origins[tn_slice], ray_directions[tn_slice], ray_bounds[tn_slice]))
+            for name, rgb in outputs.items():
+                if name not in images:
+                    images[name] = rgb.new_empty(ray_directions.shape[0], 3)
+
+                images[name][tn_slice] = rgb
+
+        images = {name: image.view(view_count, height, width, 3) for name, image in images.items()}
+
+        return images, targets
+
+    def log_validation_images(self, batch_idx, images, targets):
+        # Indexed by the configured batch size, the last batch may hold fewer views
+        view_batch_size = self.cfg.nerf.validation.get("view_batch_size", 1)
+        for i in range(targets.shape[0]):
+            view_idx = str(batch_idx * view_batch_size + i)
+            for name, image in images.items():
+                self.logger.experiment.add_image(f"validation/rgb_{name}/" + view_idx, cast_to_image(image[i]), self.global_step)
+
+            self.logger.experiment.add_image("validation/img_target/" + view_idx, cast_to_image(targets[i]), self.global_step)
+
+    def autocast(self):
+        # Mixed precision MLP queries, the sampling and compositing stay in full precision
+        return autocast(self.cfg.experiment.get("precision", 32), self.device)
+
     def sample_points(self, points, rays=None, **kwargs):
         # Get finest model
         model = self.get_model()
@@ -72,6 +145,10 @@ class BaseModel(pl.LightningModule):
 
         return results
 
+    def sample_views(self, points, view_directions):
+        # Finest model queried from several viewing directions, the trunk is shared across the views
+        return self.get_model().evaluate_views(points, view_directions)
+
     def validation_epoch_end(self, outputs):
         log_mean = {"log": {}}
         for k in outputs[0]["log"].keys():
@@ -84,22 +161,32 @@ class BaseModel(pl.LightningModule):
             assert self.val_dataset.target_mesh is not None, "To compute the " \
                 "chamfer loss, a target mesh .obj must be provided in the dataset folder"
 
-            # Target model to query based on the grid
-            model = self.get_model()
+            if self.density_grid is None:
+                experiment = self.cfg.experiment
+                self.density_grid = IncrementalDensityGrid(
+                    experiment.get("chamfer_resolution", 128), experiment.get("chamfer_limit", 1.2),
+                    experiment.get("chamfer_iso_level", 32.0), experiment.get("chamfer_block_size", 16),
+                    experiment.get("chamfer_coarse_step", 4)
+                )
 
-            # Read the input 3D model
-            vertices, faces, _, _, _, _ = extract_geometry(model, self.device, None)
+            # Read the input 3D model, only the changed blocks of the cached grid are queried
+            mesh, refreshed, elapsed = self.density_grid.extract_geometry(self, self.device)
+            log_mean["log"]["validation/chamfer_refreshed"] = torch.tensor(refreshed)
+            log_mean["log"]["validation/chamfer_time"] = torch.tensor(elapsed)
 
-            # We construct a Meshes structure for the target mesh
-            input_mesh = create_mesh(vertices, faces)
+            if mesh is not None:
+                vertices, faces, _ = mesh
 
-            # Sparse sampling
-            target_samples = sample_points_from_meshes(self.val_dataset.target_mesh,
-                                                       self.cfg.experiment.chamfer_sampling_size)
-            input_samples = sample_points_from_meshes(input_mesh, self.cfg.experiment.chamfer_sampling_size)
+                # We construct a Meshes structure for the target mesh
+                input_mesh = create_mesh(vertices.float(), faces.long())
 
-            chamfer_loss, _ = chamfer_distance(target_samples, input_samples)
-            log_mean["log"]["validation/chamfer_loss"] = chamfer_loss
+                # Sparse sampling
+                target_samples = sample_points_from_meshes(self.val_dataset.target_mesh,
+                                                           self.cfg.experiment.chamfer_sampling_size)
+                input_samples = sample_points_from_meshes(input_mesh, self.cfg.experiment.chamfer_sampling_size)
+
+                chamfer_loss, _ = chamfer_distance(target_samples, input_samples.to(target_samples.device))
+                log_mean["log"]["validation/chamfer_loss"] = chamfer_loss
 
         return log_mean
 
@@ -117,8 +204,44 @@ class BaseModel(pl.LightningModule):
     def load_train_dataset(self):
         # Create dataset
         self.train_dataset = self.load_dataset(DatasetType.TRAIN)
+        self.load_sampling_weights()
+
+    @property
+    def importance_sampler(self):
+        if self.train_dataset is not None and isinstance(self.train_dataset.pixel_sampler, ImportancePixelSampler):
+            return self.train_dataset.pixel_sampler
+
+        return None
+
+    def load_sampling_weights(self):
+        if self.importance_sampler is not None and self.sampling_weights is not None:
+            self.importance_sampler.load_state_dict(self.sampling_weights)
+
+    def update_sampling_weights(self, bundle, tn_slice, rgb, rgb_target):
+        # Feed the per ray errors back to the importance sampler
+        if self.importance_sampler is not None and bundle.ray_pixels is not None:
+            errors = ((rgb.detach() - rgb_target) ** 2).mean(dim=-1).cpu()
+            self.importance_sampler.update(bundle.ray_images[tn_slice].cpu(), bundle.ray_pixels[tn_slice].cpu(), errors)
+
+    def on_save_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        if self.importance_sampler is not None:
+            checkpoint['sampling_weights'] = self.importance_sampler.state_dict()
+
+            # Keep a copy along with the cached dataset
+            if self.cfg.dataset.caching.use_caching:
+                self.train_dataset.save_sampling_weights()
+
+    def on_load_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        self.sampling_weights = checkpoint.get('sampling_weights')
+        self.load_sampling_weights()
 
     def train_dataloader(self):
+        if self.train_dataset.global_sampling:
+            # Ray batches across all the images, the sampler yields whole batches of ray indices
+            sampler = RayBatchSampler(self.train_dataset, self.cfg.nerf.train.num_random_rays)
+            return DataLoader(self.train_dataset, batch_size=None, sampler=sampler,
+                              num_workers=self.cfg.dataset.num_workers, pin_memory=False)
+
         # Create data loader
         train_dataloader = DataLoader(self.train_dataset, batch_size=1, shuffle=False,
                                       num_workers=self.cfg.dataset.num_workers, pin_memory=False)
@@ -141,8 +264,9 @@ class BaseModel(pl.LightningModule):
             sampler = torch.utils.data.RandomSampler(self.val_dataset, replacement=True,
                                                      num_samples=self.val_num_samples)
 
-        # Create data loader
-        val_dataloader = DataLoader(self.val_dataset, shuffle=False, batch_size=1, sampler=sampler,
+        # Create data loader, several views are rendered together
+        batch_size = self.cfg.nerf.validation.get("view_batch_size", 1)
+        val_dataloader = DataLoader(self.val_dataset, shuffle=False, batch_size=batch_size, sampler=sampler,
                                     num_workers=self.cfg.dataset.num_workers, pin_memory=False)
 
         return val_dataloader
@@ -4,7 +4,7 @@ from nerf import TreeSampling
 from models import BaseModel
 from models.model_helpers import intervals_to_ray_points
 from typing import Dict, Any
-from nerf import models, cast_to_image, RaySampleInterval
+from nerf import models, RaySampleInterval
 from data.data_helpers import DataBundle
 from nerf.loggers import LoggerDepthProjection, LoggerTreeWeights, LoggerTree, LoggerDepthLoss
 
@@ -39,7 +39,8 @@ class BuFFModel(BaseModel):
 
         Returns: Tensor with the calculated pixel value for each ray.
         """
-        ray_origins, ray_directions, (near, far) = x
+        ray_origins, ray_directions, ray_bounds = x
+        near, far = ray_bounds[..., 0], ray_bounds[..., 1]
 
         # Get current configuration
         nerf_cfg = self.cfg.nerf.train if self.model.training else self.cfg.nerf.validation
@@ -49,17 +50,20 @@ class BuFFModel(BaseModel):
         ray_samples = self.sampler(nerf_cfg, ray_count, near, far)
 
         # Update the samples
-        ray_intervals, indices, mask = self.tree.batch_ray_voxel_intersect(ray_origins, ray_directions, near, far, samples_count=nerf_cfg.num_coarse)
+        if self.cfg.tree.get("traversal", "dense") == "sparse":
+            intersect = self.tree.batch_ray_voxel_traverse
+        else:
+            intersect = self.tree.batch_ray_voxel_intersect
+
+        ray_intervals, indices, mask = intersect(ray_origins, ray_directions, near, far, samples_count=nerf_cfg.num_coarse)
         ray_intervals[~mask] = ray_samples[~mask]
 
         # Samples across each ray (num_rays, samples_count, 3)
         ray_samples = intervals_to_ray_points(ray_intervals, ray_directions, ray_origins)
 
-        # Expand rays to match batch size
-        expanded_ray_directions = ray_directions[..., None, :].expand_as(ray_samples)
-
-        # Model inference
-        radiance_field = self.model(ray_samples, expanded_ray_directions)
+        # Model inference, the directions are encoded once per ray
+        with self.autocast():
+            radiance_field = self.model(ray_samples, ray_directions)
         bundle = self.volume_renderer(radiance_field, ray_intervals, ray_directions)
 
         if self.training:
@@ -87,6 +91,9 @@ class BuFFModel(BaseModel):
         loss = self.loss(output_bundle.rgb_map, bundle.ray_targets)
         psnr = self.criterion_psnr(loss)
 
+        # Importance sampling feedback
+        self.update_sampling_weights(bundle, slice(None), output_bundle.rgb_map, bundle.ray_targets)
+
         log_vals = {
             "train/loss": loss,
             "train/psnr": psnr,
@@ -115,47 +122,23 @@ class BuFFModel(BaseModel):
             }
         }
 
-    def validation_step(self, image_ray_batch, batch_idx):
-        bundle = DataBundle.deserialize(image_ray_batch).to_ray_batch()
-
-        # Manual batching, since images are expensive to be kept on GPU
-        batch_size = self.cfg.nerf.validation.chunksize
-        batch_count = bundle.ray_targets.shape[0] / batch_size
+    def render_outputs(self, ray_batch):
+        return {"coarse": self.forward(ray_batch).rgb_map}
 
-        loss = 0.
-        rgb_chunks = []
-        for i in range(0, bundle.ray_targets.shape[0], batch_size):
-            # re-usable slice
-            tn_slice = slice(i, i + batch_size)
-
-            output_bundle = self.forward((bundle.ray_origins, bundle.ray_directions[tn_slice], bundle.ray_bounds))
-            loss += self.loss(output_bundle.rgb_map, bundle.ray_targets[tn_slice])
-            rgb_chunks.append(output_bundle.rgb_map)
-
-        # Mean loss
-        loss /= batch_count
+    def validation_step(self, image_ray_batch, batch_idx):
+        bundle = DataBundle.deserialize(image_ray_batch)
 
-        rgb_map = torch.cat(rgb_chunks, 0)
-        self.logger.experiment.add_image(
-            "validation/rgb_coarse/" + str(batch_idx),
-            cast_to_image(rgb_map.view(bundle.hwf[0], bundle.hwf[1], 3)),
-            self.global_step,
-        )
+        # Streamed rendering of the batched views
+        images, targets = self.render_validation(bundle)
+        self.log_validation_images(batch_idx, images, targets)
 
+        loss = self.loss(images["coarse"], targets)
         psnr = self.criterion_psnr(loss)
         log_vals = {
             "validation/loss": loss,
             "validation/psnr": psnr
         }
 
-        self.logger.experiment.add_image(
-            "validation/img_target/" + str(batch_idx),
-            cast_to_image(
-                bundle.ray_targets.view(bundle.hwf[0], bundle.hwf[1], 3)
-            ),
-            self.global_step,
-        )
-
         output = {
             "val_loss": loss,
             "log": log_vals
@@ -164,7 +147,9 @@ class BuFFModel(BaseModel):
         return output
 
     def on_save_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        super(BuFFModel, self).on_save_checkpoint(checkpoint)
         checkpoint['tree'] = self.tree.serialize()
 
     def on_load_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        super(BuFFModel, self).on_load_checkpoint(checkpoint)
         self.tree.deserialize(checkpoint['tree'])
@@ -2,6 +2,8 @@ import collections
 import numpy as np
 import torch
 
+from nerf import broadcast_ray_features
+
 
 def flatten_dict(d, parent_key="", sep="_"):
     items = []
@@ -35,6 +37,22 @@ def intervals_to_ray_points(point_intervals, ray_directions, ray_origin):
     return ray_points
 
 
+def query_packed_samples(model, ray_points, ray_directions, samples_mask = None):
+    """ Queries the model only on the masked samples, packed as a ragged batch, the rest is left empty.
+    The directions are either per sample or per ray.
+    """
+    if samples_mask is None:
+        return model(ray_points, ray_directions)
+
+    # Full precision buffer, the queries may come from autocast
+    radiance_field = ray_points.new_zeros(*samples_mask.shape, 4, dtype=torch.float)
+    if samples_mask.any():
+        ray_directions = broadcast_ray_features(ray_directions, ray_points)
+        radiance_field[samples_mask] = model(ray_points[samples_mask], ray_directions[samples_mask]).float()
+
+    return radiance_field
+
+
 def get_ln_samples(near, far, num_rays, options, mode, type, device, total):
     t_vals = torch.linspace(0.0, 1.0, total, dtype=type, device=device)
 
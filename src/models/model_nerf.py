@@ -1,9 +1,9 @@
 import torch
 
 from models import BaseModel
-from models.model_helpers import intervals_to_ray_points
+from models.model_helpers import intervals_to_ray_points, query_packed_samples
 from typing import Tuple
-from nerf import models, cast_to_image, SamplePDF, RaySampleInterval
+from nerf import models, SamplePDF, RaySampleInterval, OccupancyGrid
 from data.data_helpers import DataBundle
 
 
@@ -31,6 +31,15 @@ class NeRFModel(BaseModel):
         self.sample_pdf = SamplePDF(self.cfg.nerf.train.num_fine)
         self.sampler = RaySampleInterval(self.cfg.nerf.train.num_coarse)
 
+        # Optional occupancy grid for empty space skipping of the coarse samples
+        self.occupancy_grid = None
+        if hasattr(self.cfg.nerf, "occupancy") and self.cfg.nerf.occupancy.use_occupancy:
+            occupancy = self.cfg.nerf.occupancy
+            self.occupancy_grid = OccupancyGrid(
+                occupancy.resolution, occupancy.limit, occupancy.threshold,
+                occupancy.get("samples_per_cell", 4), occupancy.get("decay", 0.95)
+            )
+
     def get_model(self):
         return self.model_fine if self.model_fine is not None else self.model_coarse
 
@@ -42,7 +51,8 @@ class NeRFModel(BaseModel):
 
         Returns: Tensor with the calculated pixel value for each ray.
         """
-        ray_origins, ray_directions, (near, far) = x
+        ray_origins, ray_directions, ray_bounds = x
+        near, far = ray_bounds[..., 0], ray_bounds[..., 1]
 
         # Get current configuration
         nerf_cfg = self.cfg.nerf.train if self.model_coarse.training else self.cfg.nerf.validation
@@ -54,11 +64,14 @@ class NeRFModel(BaseModel):
         # Samples across each ray (num_rays, samples_count, 3)
         ray_points = intervals_to_ray_points(ray_intervals, ray_directions, ray_origins)
 
-        # Expand rays to match batch size
-        expanded_ray_directions = ray_directions[..., None, :].expand_as(ray_points)
+        # Drop the samples within empty cells
+        samples_mask = None
+        if self.occupancy_grid is not None:
+            samples_mask = self.occupancy_grid(ray_points)
 
-        # Coarse inference
-        coarse_radiance_field = self.model_coarse(ray_points, expanded_ray_directions)
+        # Coarse inference, the directions are encoded once per ray
+        with self.autocast():
+            coarse_radiance_field = query_packed_samples(self.model_coarse, ray_points, ray_directions, samples_mask)
         coarse_bundle = self.volume_renderer(coarse_radiance_field, ray_intervals, ray_directions)
 
         fine_bundle = None
@@ -68,16 +81,19 @@ class NeRFModel(BaseModel):
                 fine_ray_intervals, ray_directions, ray_origins
             )
 
-            # Expand rays to match batch_size
-            expanded_ray_directions = ray_directions[..., None, :].expand_as(ray_points)
-
             # Fine inference
-            fine_radiance_field = self.model_fine(ray_points, expanded_ray_directions)
+            with self.autocast():
+                fine_radiance_field = self.model_fine(ray_points, ray_directions)
             fine_bundle = self.volume_renderer(fine_radiance_field, fine_ray_intervals, ray_directions)
 
         return coarse_bundle, fine_bundle
 
     def query(self, ray_batch):
+        # Inference with early ray termination, if enabled
+        segment_size = self.cfg.nerf.validation.get("segment_size", 0)
+        if segment_size > 0:
+            return self.query_marching(ray_batch, segment_size)
+
         # Fine query
         coarse_bundle, fine_bundle = self.forward(ray_batch)
         if fine_bundle is not None:
@@ -85,41 +101,106 @@ class NeRFModel(BaseModel):
 
         return coarse_bundle
 
+    def query_marching(self, ray_batch, segment_size):
+        ray_origins, ray_directions, ray_bounds = ray_batch
+        near, far = ray_bounds[..., 0], ray_bounds[..., 1]
+
+        # Generating depth samples
+        ray_count = ray_directions.shape[0]
+        ray_intervals = self.sampler(self.cfg.nerf.validation, ray_count, near, far)
+        ray_points = intervals_to_ray_points(ray_intervals, ray_directions, ray_origins)
+
+        # Drop the samples within empty cells
+        samples_mask = None
+        if self.occupancy_grid is not None:
+            samples_mask = self.occupancy_grid(ray_points)
+
+        # Coarse marching, the occluded samples are never queried
+        with self.autocast():
+            bundle = self.volume_renderer.march(
+                self.model_coarse, ray_points, ray_intervals, ray_directions, segment_size, samples_mask
+            )
+
+        if self.model_fine is not None:
+            fine_ray_intervals = self.sample_pdf(ray_intervals, bundle.weights, self.cfg.nerf.validation.perturb)
+            ray_points = intervals_to_ray_points(fine_ray_intervals, ray_directions, ray_origins)
+
+            # Fine marching
+            with self.autocast():
+                bundle = self.volume_renderer.march(
+                    self.model_fine, ray_points, fine_ray_intervals, ray_directions, segment_size
+                )
+
+        return bundle
+
+    def update_occupancy_grid(self):
+        occupancy = self.cfg.nerf.occupancy
+        step = self.global_step - occupancy.step_size_offset
+        if step >= 0 and step % occupancy.step_size_update == 0:
+            self.occupancy_grid.update(self.model_coarse)
+
     def training_step(self, ray_batch, batch_idx):
+        # Refresh the occupancy grid from the coarse model
+        if self.occupancy_grid is not None:
+            self.update_occupancy_grid()
+
         # Unpacking bundle
         bundle = DataBundle.deserialize(ray_batch).to("cpu").to_ray_batch()
 
         # Manual batching, since images are expensive to be kept on GPU
         batch_size = self.cfg.nerf.train.chunksize
         batch_count = bundle.ray_targets.shape[0] / batch_size
+        chunk_backward = self.cfg.nerf.train.get("chunk_backward", False)
 
         coarse_loss, fine_loss = 0, 0
         for i in range(0, bundle.ray_targets.shape[0], batch_size):
             # Re-usable slice, maybe generator to use instead
             tn_slice = slice(i, i + batch_size)
 
-            if self.cfg.dataset.use_ndc:
+            # Origins per ray, in normalized device coordinates or drawn across all the images
+            if self.cfg.dataset.use_ndc or self.train_dataset.global_sampling:
                 ray_origins = bundle.ray_origins[tn_slice].to(self.device)
             else:
                 ray_origins = bundle.ray_origins.to(self.device)
 
+            # Bounds per ray when drawn across all the images
+            if bundle.ray_bounds.dim() == 2:
+                ray_bounds = bundle.ray_bounds[tn_slice].to(self.device)
+            else:
+                ray_bounds = bundle.ray_bounds.to(self.device)
+
             rgb_target = bundle.ray_targets[tn_slice].to(self.device)
 
             # Ray batch
-            ray_batch = (ray_origins, bundle.ray_directions[tn_slice].to(self.device), bundle.ray_bounds.to(self.device))
+            ray_batch = (ray_origins, bundle.ray_directions[tn_slice].to(self.device), ray_bounds)
 
             # Forward pass
             coarse_bundle, fine_bundle = self.forward(ray_batch)
-            coarse_loss += self.loss(coarse_bundle.rgb_map, rgb_target)
+            coarse_chunk_loss = self.loss(coarse_bundle.rgb_map, rgb_target)
 
             # Early stopping if the scene data is too sparse
             self.check_early_stopping(coarse_bundle.rgb_map)
+
+            fine_chunk_loss = 0
             if self.model_fine is not None:
-                fine_loss += self.loss(fine_bundle.rgb_map, rgb_target)
+                fine_chunk_loss = self.loss(fine_bundle.rgb_map, rgb_target)
 
                 # Early stopping if the scene data is too sparse
                 self.check_early_stopping(fine_bundle.rgb_map)
 
+            # Immediate backward, only the graph of a single chunk is kept alive
+            if chunk_backward:
+                self.backward_chunk((coarse_chunk_loss + fine_chunk_loss) / batch_count)
+                coarse_chunk_loss = coarse_chunk_loss.detach()
+                fine_chunk_loss = fine_chunk_loss.detach() if self.model_fine is not None else 0
+
+            coarse_loss += coarse_chunk_loss
+            fine_loss += fine_chunk_loss
+
+            # Importance sampling feedback from the finest output
+            output_bundle = fine_bundle if fine_bundle is not None else coarse_bundle
+            self.update_sampling_weights(bundle, tn_slice, output_bundle.rgb_map, rgb_target)
+
         #  Compute loss
         coarse_loss /= batch_count
         coarse_psnr = self.criterion_psnr(coarse_loss)
@@ -129,6 +210,9 @@ class NeRFModel(BaseModel):
             "train/coarse_psnr": coarse_psnr,
         }
 
+        if self.occupancy_grid is not None:
+            log_vals["train/occupancy"] = self.occupancy_grid.occupancy()
+
         loss = coarse_loss
         if self.cfg.models.use_fine:
             fine_loss /= batch_count
@@ -150,61 +234,51 @@ class NeRFModel(BaseModel):
             }
         }
 
-    def validation_step(self, image_ray_batch, batch_idx):
-        bundle = DataBundle.deserialize(image_ray_batch).to_ray_batch()
+    def backward_chunk(self, loss):
+        # Averaged over the accumulated batches and scaled as the trainer would in half precision, the gradients
+        # accumulate until the optimizer step
+        loss = loss / self.trainer.accumulate_grad_batches
 
-        # Manual batching, since images are expensive to be kept on GPU
-        batch_size = self.cfg.nerf.validation.chunksize
-        batch_count = bundle.ray_targets.shape[0] / batch_size
+        scaler = getattr(self.trainer, "scaler", None)
+        if scaler is not None:
+            loss = scaler.scale(loss)
 
-        coarse_loss = 0
-        fine_loss = 0
-        all_rgb_coarse = []
-        all_rgb_fine = []
-        for i in range(0, bundle.ray_targets.shape[0], batch_size):
-            # re-usable slice
-            tn_slice = slice(i, i + batch_size)
-            rgb_target = bundle.ray_targets[tn_slice]
-            if self.cfg.dataset.use_ndc:
-                ray_origins = bundle.ray_origins[tn_slice]
-            else:
-                ray_origins = bundle.ray_origins
+        loss.backward()
 
-            coarse_bundle, fine_bundle = self.forward((ray_origins, bundle.ray_directions[tn_slice], bundle.ray_bounds))
-            coarse_loss += self.loss(coarse_bundle.rgb_map, rgb_target)
+    def backward(self, trainer, loss, optimizer, optimizer_idx):
+        # The gradients were already accumulated chunk by chunk within the training step
+        if self.cfg.nerf.train.get("chunk_backward", False):
+            return
 
-            all_rgb_coarse.append(coarse_bundle.rgb_map)
-            if self.model_fine is not None:
-                fine_loss += self.loss(fine_bundle.rgb_map, rgb_target)
+        super(NeRFModel, self).backward(trainer, loss, optimizer, optimizer_idx)
 
-                all_rgb_fine.append(fine_bundle.rgb_map)
+    def render_outputs(self, ray_batch):
+        coarse_bundle, fine_bundle = self.forward(ray_batch)
 
-        coarse_loss /= batch_count
-        loss = coarse_loss
+        outputs = {"coarse": coarse_bundle.rgb_map}
+        if fine_bundle is not None:
+            outputs["fine"] = fine_bundle.rgb_map
+
+        return outputs
 
-        rgb_coarse = torch.cat(all_rgb_coarse, 0)
-        self.logger.experiment.add_image(
-            "validation/rgb_coarse/" + str(batch_idx),
-            cast_to_image(rgb_coarse.view(bundle.hwf[0], bundle.hwf[1], 3)),
-            self.global_step,
-        )
+    def validation_step(self, image_ray_batch, batch_idx):
+        bundle = DataBundle.deserialize(image_ray_batch)
+
+        # Streamed rendering of the batched views
+        images, targets = self.render_validation(bundle)
+        self.log_validation_images(batch_idx, images, targets)
 
+        coarse_loss = self.loss(images["coarse"], targets)
         coarse_psnr = self.criterion_psnr(coarse_loss)
         log_vals = {
             "validation/coarse_loss": coarse_loss,
             "validation/coarse_psnr": coarse_psnr
         }
 
+        loss = coarse_loss
         if self.model_fine is not None:
-            rgb_fine = torch.cat(all_rgb_fine, 0)
-            self.logger.experiment.add_image(
-                "validation/rgb_fine/" + str(batch_idx),
-                cast_to_image(rgb_fine.view(bundle.hwf[0], bundle.hwf[1], 3)),
-                self.global_step,
-            )
-
-            fine_loss /= batch_count
-            loss += fine_loss
+            fine_loss = self.loss(images["fine"], targets)
+            loss = loss + fine_loss
 
             fine_psnr = self.criterion_psnr(fine_loss)
             log_vals = {
@@ -213,12 +287,6 @@ class NeRFModel(BaseModel):
                 "validation/fine_psnr": fine_psnr
             }
 
-        self.logger.experiment.add_image(
-            "validation/img_target/" + str(batch_idx),
-            cast_to_image(bundle.ray_targets.view(bundle.hwf[0], bundle.hwf[1], 3)),
-            self.global_step,
-        )
-
         output = {
             "val_loss": loss,
             "log": {
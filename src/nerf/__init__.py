@@ -3,3 +3,6 @@ from .tree import *
 from .nerf_helpers import *
 from .modules import *
 from .models import *
+from .baked import *
+from .export import *
+from .decimation import *
@@ -0,0 +1,102 @@
+import math
+import torch
+
+from nerf.nerf_helpers import load_memmap_arrays
+from nerf.modules import broadcast_ray_features
+
+SH_C0 = 0.28209479177387814
+SH_C1 = 0.4886025119029199
+SH_C2 = [1.0925484305920792, -1.0925484305920792, 0.31539156525252005, -1.0925484305920792, 0.5462742152960396]
+
+
+def spherical_harmonics(dirs, degree = 2):
+    """ Real spherical harmonics basis evaluated for the unit directions.
+    Args:
+        dirs (torch.Tensor): Tensor (...x3) of unit directions.
+        degree (int): Max degree, up to 2.
+    Returns:
+        basis (torch.Tensor): Tensor (...x(degree + 1)^2) of the basis values.
+    """
+    x, y, z = dirs.unbind(-1)
+
+    basis = [torch.full_like(x, SH_C0)]
+    if degree > 0:
+        basis += [-SH_C1 * y, SH_C1 * z, -SH_C1 * x]
+    if degree > 1:
+        basis += [
+            SH_C2[0] * x * y,
+            SH_C2[1] * y * z,
+            SH_C2[2] * (2.0 * z * z - x * x - y * y),
+            SH_C2[3] * x * z,
+            SH_C2[4] * (x * x - y * y),
+        ]
+
+    return torch.stack(basis, -1)
+
+
+def fibonacci_directions(count):
+    """ Evenly distributed unit directions on the sphere. """
+    indices = torch.arange(count, dtype = torch.float) + 0.5
+    phi = torch.acos(1.0 - 2.0 * indices / count)
+    theta = math.pi * (1.0 + 5.0 ** 0.5) * indices
+
+    return torch.stack((torch.cos(theta) * torch.sin(phi), torch.sin(theta) * torch.sin(phi), torch.cos(phi)), -1)
+
+
+class BakedRadianceField(torch.nn.Module):
+    """Sparse grid of baked density and spherical harmonics colour coefficients, queried by trilinear lookup.
+    The lattice spans (-limit, limit) with res points per axis, empty points are indexed by -1.
+    """
+
+    def __init__(self, index, features, res, limit, sh_degree):
+        super(BakedRadianceField, self).__init__()
+        self.res = res
+        self.limit = limit
+        self.sh_degree = sh_degree
+        self.register_buffer("index", index, persistent = False)
+        self.register_buffer("features", features, persistent = False)
+
+    @staticmethod
+    def load(path):
+        # Copy-on-write mapping, pages are read lazily and shared across processes
+        arrays, meta = load_memmap_arrays(path, mode = "c")
+        index = torch.from_numpy(arrays["index"])
+        features = torch.from_numpy(arrays["features"])
+
+        return BakedRadianceField(index, features, meta["res"], meta["limit"], meta["sh_degree"])
+
+    def forward(self, ray_points, ray_directions = None):
+        shape = ray_points.shape[:-1]
+        points = ray_points.reshape(-1, 3)
+
+        # Continuous lattice coordinates
+        coords = (points + self.limit) / (2 * self.limit) * (self.res - 1)
+        mask_inside = ((coords >= 0) & (coords <= self.res - 1)).all(-1)
+        coords = coords.clamp(0, self.res - 1)
+        base = coords.floor().long().clamp(max = self.res - 2)
+        frac = coords - base
+
+        # Trilinear interpolation over the 8 lattice corners
+        features = torch.zeros(points.shape[0], self.features.shape[-1], device = points.device)
+        for corner in range(8):
+            offset = torch.tensor([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1], device = points.device)
+            indices = base + offset
+            indices = (indices[:, 0] * self.res + indices[:, 1]) * self.res + indices[:, 2]
+
+            slots = self.index[indices].long()
+            weights = torch.where(offset.bool(), frac, 1.0 - frac).prod(-1) * (slots >= 0)
+            features += weights[:, None] * self.features[slots.clamp(min = 0)].float()
+
+        features = features * mask_inside[:, None]
+        density = features[:, :1]
+
+        # View dependent colour from the spherical harmonics coefficients
+        coefficients = features[:, 1:].view(points.shape[0], 3, -1)
+        if ray_directions is not None:
+            dirs = broadcast_ray_features(ray_directions, ray_points).reshape(-1, 3)
+            dirs = dirs / dirs.norm(p = 2, dim = -1, keepdim = True)
+            rgb = (coefficients * spherical_harmonics(dirs, self.sh_degree)[:, None, :]).sum(-1)
+        else:
+            rgb = coefficients[..., 0] * SH_C0
+
+        return torch.cat((rgb.clamp(0.0, 1.0), density), -1).view(*shape, 4)
@@ -0,0 +1,234 @@
+import numpy as np
+
+# Weight of the planes perpendicular to the boundary edges, keeping the open borders in place
+BOUNDARY_WEIGHT = 1e3
+
+# Matchings drawn per pass while some of the collapses flip a triangle
+MAX_ATTEMPTS = 4
+
+
+def scatter_sum(index, values, count):
+    """ Sums the rows (NxC) of the values into count rows selected by the index (N). """
+    return np.stack([np.bincount(index, weights = values[:, i], minlength = count) for i in range(values.shape[1])], -1)
+
+
+def remove_degenerate_triangles(triangles):
+    """ Drops the triangles with repeated corners, and the duplicates regardless of their winding. """
+    mask = (triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) & (triangles[:, 2] != triangles[:, 0])
+    triangles = triangles[mask]
+
+    _, first = np.unique(np.sort(triangles, axis = -1), axis = 0, return_index = True)
+
+    return triangles[np.sort(first)]
+
+
+def merge_duplicate_vertices(vertices, triangles, normals = None, tolerance = 1e-6):
+    """ Welds the vertices within the tolerance of each other into their mean, the normals are averaged.
+    Args:
+        vertices (np.ndarray): Array (Vx3) of the vertices.
+        triangles (np.ndarray): Array (Fx3) of the triangles.
+        normals (np.ndarray): Optional array (Vx3) of the vertex normals.
+        tolerance (float): Distance under which the vertices are merged, on a regular grid.
+    Returns:
+        vertices (np.ndarray): Array (V'x3) of the welded vertices.
+        triangles (np.ndarray): Array (F'x3) of the triangles, without the degenerate ones.
+        normals (np.ndarray): Array (V'x3) of the welded vertex normals, if given.
+    """
+    keys = np.round(vertices / tolerance).astype(np.int64)
+    _, inverse = np.unique(keys, axis = 0, return_inverse = True)
+    inverse = inverse.reshape(-1)
+    count = inverse.max(initial = -1) + 1
+
+    weights = np.bincount(inverse, minlength = count)[:, None]
+    merged = scatter_sum(inverse, vertices, count) / weights
+    if normals is not None:
+        normals = scatter_sum(inverse, normals, count)
+        normals = normals / np.maximum(np.linalg.norm(normals, axis = -1, keepdims = True), 1e-10)
+
+    triangles = remove_degenerate_triangles(inverse[triangles])
+
+    return merged, triangles, normals
+
+
+def face_planes(vertices, triangles):
+    # Unit plane (n, -n.p) of each triangle, with the doubled area
+    p0, p1, p2 = [vertices[triangles[:, i]] for i in range(3)]
+    normals = np.cross(p1 - p0, p2 - p0)
+    areas = np.linalg.norm(normals, axis = -1)
+    normals = normals / np.maximum(areas, 1e-20)[:, None]
+
+    return np.concatenate((normals, -(normals * p0).sum(-1, keepdims = True)), -1), areas
+
+
+def unique_edges(triangles):
+    """ Undirected edges (Ex2) of the triangles, with the owner triangle and the count of triangles of each. """
+    edges = np.concatenate((triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]), 0)
+    owners = np.tile(np.arange(triangles.shape[0]), 3)
+
+    keys = np.sort(edges, axis = -1)
+    keys, first, counts = np.unique(keys, axis = 0, return_index = True, return_counts = True)
+
+    return keys, edges[first], owners[first], counts
+
+
+def vertex_quadrics(vertices, triangles):
+    """ Area weighted error quadrics (Vx4x4) of the planes around each vertex, with the boundary constraints. """
+    planes, areas = face_planes(vertices, triangles)
+    quadrics = areas[:, None, None] * planes[:, :, None] * planes[:, None, :]
+    quadrics = scatter_sum(triangles.reshape(-1), np.repeat(quadrics.reshape(-1, 16), 3, axis = 0), vertices.shape[0])
+
+    # Planes through the boundary edges, perpendicular to their triangle
+    _, edges, owners, counts = unique_edges(triangles)
+    edges, owners = edges[counts == 1], owners[counts == 1]
+    if edges.shape[0] > 0:
+        p0, p1 = vertices[edges[:, 0]], vertices[edges[:, 1]]
+        normals = np.cross(p1 - p0, planes[owners, :3])
+        lengths = np.linalg.norm(normals, axis = -1)
+        normals = normals / np.maximum(lengths, 1e-20)[:, None]
+
+        boundary = np.concatenate((normals, -(normals * p0).sum(-1, keepdims = True)), -1)
+        boundary = BOUNDARY_WEIGHT * (lengths ** 2)[:, None, None] * boundary[:, :, None] * boundary[:, None, :]
+        quadrics += scatter_sum(edges.reshape(-1), np.repeat(boundary.reshape(-1, 16), 2, axis = 0), vertices.shape[0])
+
+    return quadrics.reshape(-1, 4, 4)
+
+
+def collapse_costs(vertices, quadrics, edges):
+    """ Cheapest collapse position of each edge, among its ends, its middle and the optimum of the quadric.
+    Returns:
+        costs (np.ndarray): Array (E) of the quadric errors.
+        targets (np.ndarray): Array (Ex3) of the collapse positions.
+    """
+    quadrics = quadrics[edges[:, 0]] + quadrics[edges[:, 1]]
+    v0, v1 = vertices[edges[:, 0]], vertices[edges[:, 1]]
+    middle = 0.5 * (v0 + v1)
+
+    # Optimum where the quadric is well conditioned and close to the edge
+    optimum = middle.copy()
+    system = quadrics[:, :3, :3]
+    solvable = np.linalg.cond(system) < 1e4
+    if solvable.any():
+        optimum[solvable] = np.linalg.solve(system[solvable], -quadrics[solvable, :3, 3:])[..., 0]
+
+    lengths = np.linalg.norm(v1 - v0, axis = -1)
+    optimum = np.where((np.linalg.norm(optimum - middle, axis = -1) <= lengths)[:, None], optimum, middle)
+
+    candidates = np.stack((v0, v1, middle, optimum), 1)
+    homogeneous = np.concatenate((candidates, np.ones_like(candidates[..., :1])), -1)
+    errors = np.einsum("eci,eij,ecj->ec", homogeneous, quadrics, homogeneous)
+
+    best = errors.argmin(-1)
+    indices = np.arange(edges.shape[0])
+
+    return errors[indices, best], candidates[indices, best]
+
+
+def select_collapses(vertex_count, edges, costs, budget, rounds = 8):
+    """ Matching of the cheapest edges, grown over a few rounds. Each round selects the edges that are the cheapest
+    available ones of both their ends, then drops the edges touching a selected end.
+    """
+    ranks = np.empty(edges.shape[0], dtype = np.int64)
+    ranks[np.argsort(costs, kind = "stable")] = np.arange(edges.shape[0])
+
+    available, selected = np.isfinite(costs), []
+    for _ in range(rounds):
+        candidates = np.nonzero(available)[0]
+        if candidates.shape[0] == 0:
+            break
+
+        cheapest = np.full(vertex_count, edges.shape[0], dtype = np.int64)
+        np.minimum.at(cheapest, edges[candidates, 0], ranks[candidates])
+        np.minimum.at(cheapest, edges[candidates, 1], ranks[candidates])
+
+        mask = (cheapest[edges[candidates, 0]] == ranks[candidates]) & (cheapest[edges[candidates, 1]] == ranks[candidates])
+        selected.append(candidates[mask])
+
+        matched = np.zeros(vertex_count, dtype = bool)
+        matched[edges[candidates[mask]].reshape(-1)] = True
+        available &= ~(matched[edges[:, 0]] | matched[edges[:, 1]])
+
+    selected = np.concatenate(selected) if len(selected) > 0 else np.zeros(0, dtype = np.int64)
+
+    return selected[np.argsort(costs[selected], kind = "stable")][:budget]
+
+
+def accepted_collapses(vertices, triangles, edges, selected, positions):
+    """ Applies the selected collapses tentatively, and rejects those next to a triangle whose normal turns around. """
+    remap = np.arange(vertices.shape[0])
+    remap[edges[selected, 1]] = edges[selected, 0]
+    moved = vertices.copy()
+    moved[edges[selected, 0]] = positions[selected]
+
+    old_planes, _ = face_planes(vertices, triangles)
+    new_triangles = remap[triangles]
+    new_planes, new_areas = face_planes(moved, new_triangles)
+
+    degenerate = (new_triangles[:, 0] == new_triangles[:, 1]) | (new_triangles[:, 1] == new_triangles[:, 2]) | \
+                 (new_triangles[:, 2] == new_triangles[:, 0])
+    flipped = ~degenerate & (((old_planes[:, :3] * new_planes[:, :3]).sum(-1) <= 0.0) | (new_areas <= 0.0))
+
+    # Collapses moving a corner of a flipped triangle
+    collapse_of = np.full(vertices.shape[0], -1, dtype = np.int64)
+    collapse_of[edges[selected].reshape(-1)] = np.repeat(np.arange(selected.shape[0]), 2)
+    rejected = collapse_of[triangles[flipped]].reshape(-1)
+
+    accepted = np.ones(selected.shape[0], dtype = bool)
+    accepted[rejected[rejected >= 0]] = False
+
+    return accepted
+
+
+def decimate_levels(vertices, triangles, normals, targets):
+    """ Quadric error decimation through the target triangle counts, from the finest to the coarsest level. Each
+    pass collapses a matching of the cheapest edges at once, rejecting the collapses that flip a triangle, and the
+    quadrics accumulate across the levels.
+    Args:
+        vertices (np.ndarray): Array (Vx3) of the welded vertices.
+        triangles (np.ndarray): Array (Fx3) of the triangles.
+        normals (np.ndarray): Array (Vx3) of the vertex normals.
+        targets (list): Target triangle counts.
+    Returns:
+        levels (list): Tuples (vertices, triangles, normals) of the compacted mesh per target.
+    """
+    vertices, normals = vertices.astype(np.float64), normals.astype(np.float64)
+    quadrics = vertex_quadrics(vertices, triangles)
+
+    levels = []
+    for target in sorted(targets, reverse = True):
+        while triangles.shape[0] > target:
+            edges, _, _, _ = unique_edges(triangles)
+            costs, positions = collapse_costs(vertices, quadrics, edges)
+
+            # Each collapse removes about two triangles
+            budget = max((triangles.shape[0] - target) // 2, 1)
+
+            # The rejected collapses are excluded from a new matching, a few times at most
+            for _ in range(MAX_ATTEMPTS):
+                selected = select_collapses(vertices.shape[0], edges, costs, budget)
+                accepted = accepted_collapses(vertices, triangles, edges, selected, positions)
+                if accepted.all():
+                    break
+
+                costs[selected[~accepted]] = np.inf
+
+            selected = selected[accepted]
+            if selected.shape[0] == 0:
+                break
+
+            # Apply the accepted collapses
+            keep, remove = edges[selected, 0], edges[selected, 1]
+            remap = np.arange(vertices.shape[0])
+            remap[remove] = keep
+            vertices[keep] = positions[selected]
+            quadrics[keep] += quadrics[remove]
+            normals[keep] += normals[remove]
+            normals[keep] /= np.maximum(np.linalg.norm(normals[keep], axis = -1, keepdims = True), 1e-10)
+
+            triangles = remove_degenerate_triangles(remap[triangles])
+
+        # Compact the referenced vertices
+        used, inverse = np.unique(triangles.reshape(-1), return_inverse = True)
+        levels.append((vertices[used], inverse.reshape(-1, 3), normals[used]))
+        print(f"Decimated to {triangles.shape[0]} triangles with {used.shape[0]} vertices")
+
+    return levels
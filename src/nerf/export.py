@@ -0,0 +1,268 @@
+import json
+import os
+import struct
+import numpy as np
+import torch
+
+# Rows formatted or packed at once, bounding the memory of the writers
+CHUNK_SIZE = 1 << 20
+
+GLB_MAGIC = 0x46546C67
+GLB_CHUNK_JSON = 0x4E4F534A
+GLB_CHUNK_BIN = 0x004E4942
+
+
+def to_numpy(array):
+    if isinstance(array, torch.Tensor):
+        return array.detach().cpu().numpy()
+
+    return np.asarray(array)
+
+
+def iterate_chunks(*arrays, chunk_size = CHUNK_SIZE):
+    """ Aligned numpy chunks of the arrays along the first dimension, the arrays may be memory-mapped. """
+    for start in range(0, len(arrays[0]), chunk_size):
+        yield [to_numpy(array[start:start + chunk_size]) for array in arrays]
+
+
+def has_attribute(attribute, vertices):
+    return attribute is not None and len(attribute) == len(vertices) and len(vertices) > 0
+
+
+def colors_to_bytes(colors):
+    return (np.clip(colors, 0.0, 1.0) * 255.0).round().astype(np.uint8)
+
+
+def export_obj(vertices, triangles, diffuse, normals, filename, uvs = None, texture_path = None, chunk_size = CHUNK_SIZE):
+    """
+    Exports a mesh in the (.obj) format, each chunk of rows is written by a single savetxt. The optional texture
+    coordinates (3Fx2) are per triangle corner, the texture is referenced by a (.mtl) material next to the mesh.
+    """
+    print('Writing to obj...')
+
+    with open(filename, "w") as fh:
+        if texture_path is not None:
+            material_path = os.path.splitext(filename)[0] + ".mtl"
+            with open(material_path, "w") as mh:
+                mh.write(f"newmtl material\nKa 1 1 1\nKd 1 1 1\nmap_Kd {os.path.basename(texture_path)}\n")
+
+            fh.write(f"mtllib {os.path.basename(material_path)}\nusemtl material\n")
+
+        # Vertices with the optional colours
+        attributes = [vertices, diffuse] if has_attribute(diffuse, vertices) else [vertices]
+        for chunk in iterate_chunks(*attributes, chunk_size = chunk_size):
+            values = np.concatenate(chunk, -1)
+            np.savetxt(fh, values, fmt = "v" + " %.6f" * values.shape[-1])
+
+        if normals is not None:
+            for (chunk,) in iterate_chunks(normals, chunk_size = chunk_size):
+                np.savetxt(fh, chunk, fmt = "vn %.6f %.6f %.6f")
+
+        if uvs is not None:
+            for (chunk,) in iterate_chunks(uvs, chunk_size = chunk_size):
+                np.savetxt(fh, chunk, fmt = "vt %.6f %.6f")
+
+            # One-based faces, the texture coordinates are per corner
+            for start in range(0, len(triangles), chunk_size):
+                chunk = to_numpy(triangles[start:start + chunk_size]).astype(np.int64) + 1
+                corners = np.arange(3 * start, 3 * (start + chunk.shape[0])).reshape(-1, 3) + 1
+                indices = np.stack((chunk, corners, chunk), -1).reshape(-1, 9)
+                np.savetxt(fh, indices, fmt = "f %d/%d/%d %d/%d/%d %d/%d/%d")
+
+            triangles = []
+
+        # One-based faces, sharing the vertex and normal indices
+        for (chunk,) in iterate_chunks(triangles, chunk_size = chunk_size):
+            indices = np.repeat(chunk.astype(np.int64) + 1, 2, axis = -1)
+            np.savetxt(fh, indices, fmt = "f %d//%d %d//%d %d//%d")
+
+    print(f"Finished writing to {filename} with {len(vertices)} vertices")
+
+
+def export_ply(vertices, triangles, diffuse, normals, filename, uvs = None, texture_path = None, chunk_size = CHUNK_SIZE):
+    """
+    Exports a mesh in the binary little endian (.ply) format.
+    """
+    if uvs is not None:
+        raise NotImplementedError("Textured meshes are not implemented for the (.ply) format!")
+
+    print('Writing to ply...')
+
+    # Vertex record layout
+    has_normals, has_colors = has_attribute(normals, vertices), has_attribute(diffuse, vertices)
+    properties = [("x", "float", "<f4"), ("y", "float", "<f4"), ("z", "float", "<f4")]
+    if has_normals:
+        properties += [("nx", "float", "<f4"), ("ny", "float", "<f4"), ("nz", "float", "<f4")]
+    if has_colors:
+        properties += [("red", "uchar", "u1"), ("green", "uchar", "u1"), ("blue", "uchar", "u1")]
+
+    vertex_dtype = np.dtype([(name, dtype) for name, _, dtype in properties])
+    face_dtype = np.dtype([("count", "u1"), ("indices", "<i4", (3,))])
+
+    header = ["ply", "format binary_little_endian 1.0", f"element vertex {len(vertices)}"]
+    header += [f"property {ply_type} {name}" for name, ply_type, _ in properties]
+    header += [f"element face {len(triangles)}", "property list uchar int vertex_indices", "end_header"]
+
+    with open(filename, "wb") as fh:
+        fh.write(("\n".join(header) + "\n").encode("ascii"))
+
+        attributes = [vertices] + ([normals] if has_normals else []) + ([diffuse] if has_colors else [])
+        for chunk in iterate_chunks(*attributes, chunk_size = chunk_size):
+            records = np.empty(chunk[0].shape[0], dtype = vertex_dtype)
+            values = np.concatenate(chunk[:2] if has_normals else chunk[:1], -1)
+            for index, name in enumerate(["x", "y", "z", "nx", "ny", "nz"][:values.shape[-1]]):
+                records[name] = values[:, index]
+
+            if has_colors:
+                colors = colors_to_bytes(chunk[-1])
+                records["red"], records["green"], records["blue"] = colors[:, 0], colors[:, 1], colors[:, 2]
+
+            fh.write(records.tobytes())
+
+        for (chunk,) in iterate_chunks(triangles, chunk_size = chunk_size):
+            records = np.empty(chunk.shape[0], dtype = face_dtype)
+            records["count"] = 3
+            records["indices"] = chunk
+            fh.write(records.tobytes())
+
+    print(f"Finished writing to {filename} with {len(vertices)} vertices")
+
+
+def export_glb(vertices, triangles, diffuse, normals, filename, uvs = None, texture_path = None, chunk_size = CHUNK_SIZE):
+    """
+    Exports a mesh in the binary glTF (.glb) format with the vertex colours, or a point cloud without triangles.
+    The optional texture coordinates (3Fx2) are per triangle corner, such that the textured mesh is unwelded,
+    and the (.png) texture is embedded.
+    """
+    print('Writing to glb...')
+
+    if uvs is not None:
+        # Vertex attributes per triangle corner
+        corners = to_numpy(triangles).astype(np.int64).ravel()
+        vertices, normals, diffuse = [
+            to_numpy(attribute)[corners] if has_attribute(attribute, vertices) else None
+            for attribute in (vertices, normals, diffuse)
+        ]
+        triangles = np.arange(corners.shape[0]).reshape(-1, 3)
+
+    vertex_count, index_count = len(vertices), 3 * len(triangles)
+    has_normals, has_colors = has_attribute(normals, vertices), has_attribute(diffuse, vertices)
+
+    # Position bounds are required by the accessor
+    bounds_min, bounds_max = np.full(3, np.inf), np.full(3, -np.inf)
+    for (chunk,) in iterate_chunks(vertices, chunk_size = chunk_size):
+        bounds_min, bounds_max = np.minimum(bounds_min, chunk.min(0)), np.maximum(bounds_max, chunk.max(0))
+
+    # Buffer layout, every view is 4 bytes aligned
+    views, accessors, attributes = [], [], {}
+
+    def add_view(byte_length, target, accessor):
+        offset = sum(view["byteLength"] for view in views)
+        views.append({"buffer": 0, "byteOffset": offset, "byteLength": byte_length, "target": target})
+        accessors.append({"bufferView": len(views) - 1, **accessor})
+
+        return len(accessors) - 1
+
+    attributes["POSITION"] = add_view(12 * vertex_count, 34962, {
+        "componentType": 5126, "count": vertex_count, "type": "VEC3",
+        "min": bounds_min.tolist(), "max": bounds_max.tolist()
+    })
+    if has_normals:
+        attributes["NORMAL"] = add_view(12 * vertex_count, 34962, {"componentType": 5126, "count": vertex_count, "type": "VEC3"})
+    if has_colors:
+        attributes["COLOR_0"] = add_view(4 * vertex_count, 34962, {
+            "componentType": 5121, "normalized": True, "count": vertex_count, "type": "VEC4"
+        })
+    if uvs is not None:
+        attributes["TEXCOORD_0"] = add_view(8 * vertex_count, 34962, {"componentType": 5126, "count": vertex_count, "type": "VEC2"})
+
+    # Triangles, otherwise points
+    primitive = {"attributes": attributes, "mode": 4 if index_count > 0 else 0}
+    if index_count > 0:
+        primitive["indices"] = add_view(4 * index_count, 34963, {"componentType": 5125, "count": index_count, "type": "SCALAR"})
+
+    # Embedded texture, as the last view padded to 4 bytes
+    image = b""
+    if texture_path is not None:
+        with open(texture_path, "rb") as fh:
+            image = fh.read()
+
+        views.append({"buffer": 0, "byteOffset": sum(view["byteLength"] for view in views), "byteLength": len(image)})
+        primitive["material"] = 0
+
+    padding = b"\0" * (-len(image) % 4)
+    bin_length = sum(view["byteLength"] for view in views) + len(padding)
+    document = {
+        "asset": {"version": "2.0"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0}],
+        "meshes": [{"primitives": [primitive]}],
+        "buffers": [{"byteLength": bin_length}],
+        "bufferViews": views,
+        "accessors": accessors,
+    }
+    if texture_path is not None:
+        document["materials"] = [{
+            "pbrMetallicRoughness": {"baseColorTexture": {"index": 0}, "metallicFactor": 0.0, "roughnessFactor": 1.0}
+        }]
+        document["textures"] = [{"sampler": 0, "source": 0}]
+        document["samplers"] = [{"magFilter": 9729, "minFilter": 9987}]
+        document["images"] = [{"bufferView": len(views) - 1, "mimeType": "image/png"}]
+
+    # JSON chunk padded with spaces
+    content = json.dumps(document, separators = (",", ":")).encode("utf-8")
+    content += b" " * (-len(content) % 4)
+
+    with open(filename, "wb") as fh:
+        fh.write(struct.pack("<III", GLB_MAGIC, 2, 12 + 8 + len(content) + 8 + bin_length))
+        fh.write(struct.pack("<II", len(content), GLB_CHUNK_JSON))
+        fh.write(content)
+        fh.write(struct.pack("<II", bin_length, GLB_CHUNK_BIN))
+
+        # Binary chunk streamed view by view
+        for (chunk,) in iterate_chunks(vertices, chunk_size = chunk_size):
+            fh.write(chunk.astype("<f4").tobytes())
+
+        if has_normals:
+            for (chunk,) in iterate_chunks(normals, chunk_size = chunk_size):
+                fh.write(chunk.astype("<f4").tobytes())
+
+        if has_colors:
+            for (chunk,) in iterate_chunks(diffuse, chunk_size = chunk_size):
+                colors = np.full((chunk.shape[0], 4), 255, dtype = np.uint8)
+                colors[:, :3] = colors_to_bytes(chunk)
+                fh.write(colors.tobytes())
+
+        if uvs is not None:
+            # Texture origin at the top left corner
+            for (chunk,) in iterate_chunks(uvs, chunk_size = chunk_size):
+                fh.write(np.stack((chunk[:, 0], 1.0 - chunk[:, 1]), -1).astype("<f4").tobytes())
+
+        for (chunk,) in iterate_chunks(triangles, chunk_size = chunk_size):
+            fh.write(chunk.astype("<u4").tobytes())
+
+        fh.write(image + padding)
+
+    print(f"Finished writing to {filename} with {vertex_count} vertices")
+
+
+MESH_EXPORTERS = {
+    ".obj": export_obj,
+    ".ply": export_ply,
+    ".glb": export_glb,
+}
+
+# Formats able to reference a texture atlas
+TEXTURED_MESH_FORMATS = [".obj", ".glb"]
+
+
+def export_mesh(vertices, triangles, diffuse, normals, filename, uvs = None, texture_path = None):
+    """ Exports a mesh in the format given by the file extension, either (.obj), (.ply) or (.glb), optionally
+    textured by the per triangle corner texture coordinates.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in MESH_EXPORTERS:
+        raise NotImplementedError(f"Mesh format {extension} not implemented!")
+
+    MESH_EXPORTERS[extension](vertices, triangles, diffuse, normals, filename, uvs, texture_path)
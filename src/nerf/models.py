@@ -1,33 +1,68 @@
+import functools
+from abc import abstractmethod
 from nerf.modules import *
 
 
-class FlexibleNeRFModel(torch.nn.Module):
+class CheckpointedModel(torch.nn.Module):
+    """ Radiance field with optional gradient checkpointing of the forward pass over segments of rays, which
+    trades recompute for activation memory. The models implement evaluate instead of forward.
+    """
+
+    def __init__(self, checkpoint_segment=0):
+        super(CheckpointedModel, self).__init__()
+        self.checkpoint_segment = checkpoint_segment
+
+    def forward(self, ray_points, ray_directions=None):
+        if self.checkpoint_segment > 0 and torch.is_grad_enabled():
+            return checkpoint_segments(self.evaluate, self.checkpoint_segment, ray_points, ray_directions)
+
+        return self.evaluate(ray_points, ray_directions)
+
+    @abstractmethod
+    def evaluate(self, ray_points, ray_directions=None):
+        pass
+
+    def evaluate_views(self, ray_points, view_directions):
+        """ Queries the samples of each ray from several viewing directions.
+        Args:
+            ray_points (torch.Tensor): Tensor (NxSx3) of the samples.
+            view_directions (torch.Tensor): Tensor (NxKx3) of the viewing directions per ray.
+        Returns:
+            radiance_field (torch.Tensor): Tensor (NxKxSx4) of the radiance field per view.
+        """
+        view_count, sample_count = view_directions.shape[-2], ray_points.shape[-2]
+        ray_points = ray_points[..., None, :, :].expand(-1, view_count, -1, -1).reshape(-1, sample_count, 3)
+        radiance_field = self.forward(ray_points, view_directions.reshape(-1, 3))
+
+        return radiance_field.view(-1, view_count, sample_count, radiance_field.shape[-1])
+
+
+class FlexibleTrunkModel(CheckpointedModel):
+    """ Trunk of skip connected layers over the encoded positions, followed by a view dependent branch. The
+    subclasses only provide the position and direction encodings.
+    """
+
     def __init__(
         self,
+        encode_xyz,
+        encode_dir,
+        dim_dir,
         num_layers=4,
         hidden_size=128,
         skip_step=4,
-        num_encoding_fn_xyz=6,
-        num_encoding_fn_dir=4,
-        include_input_xyz=True,
-        include_input_dir=True,
-        log_sampling_xyz=True,
-        log_sampling_dir=True,
         use_viewdirs=True,
-        **kwargs
+        checkpoint_layers=0,
+        checkpoint_segment=0,
     ):
-        super(FlexibleNeRFModel, self).__init__()
-        self.encode_xyz = PositionalEncoding(
-            num_encoding_fn_xyz, include_input_xyz, log_sampling_xyz
-        )
-        self.encode_dir = PositionalEncoding(
-            num_encoding_fn_dir, include_input_dir, log_sampling_dir
-        )
+        super(FlexibleTrunkModel, self).__init__(checkpoint_segment)
+        self.encode_xyz = encode_xyz
+        self.encode_dir = encode_dir
 
         self.dim_xyz = self.encode_xyz.output_size()
-        self.dim_dir = self.encode_dir.output_size()
+        self.dim_dir = dim_dir
         self.skip_step = skip_step
         self.num_layers = num_layers
+        self.checkpoint_layers = checkpoint_layers
         if not use_viewdirs:
             self.dim_dir = 0
 
@@ -57,19 +92,60 @@ class FlexibleNeRFModel(torch.nn.Module):
 
         self.relu = torch.nn.functional.relu
 
-    def forward(self, ray_points, ray_directions=None):
-        xyz = self.encode_xyz(ray_points)
-        x = self.layer1(xyz)
-        for i, layer in enumerate(self.layers_xyz):
+    def evaluate_layers(self, x, xyz, start, end):
+        for i in range(start, min(end, len(self.layers_xyz))):
             if i % self.skip_step == 0 and i > 0 and i != self.num_layers - 1:
                 x = torch.cat((x, xyz), dim=-1)
-            x = self.relu(layer(x))
+            x = self.relu(self.layers_xyz[i](x))
+
+        return x
+
+    def evaluate_trunk(self, ray_points):
+        xyz = self.encode_xyz(ray_points)
+        x = self.layer1(xyz)
+
+        # Trunk layers, optionally checkpointed in groups
+        if self.checkpoint_layers > 0 and torch.is_grad_enabled():
+            for start in range(0, len(self.layers_xyz), self.checkpoint_layers):
+                layers = functools.partial(self.evaluate_layers, start=start, end=start + self.checkpoint_layers)
+                x = checkpoint_function(layers, x, xyz)
+        else:
+            x = self.evaluate_layers(x, xyz, 0, len(self.layers_xyz))
+
+        return x
+
+    def evaluate_views(self, ray_points, view_directions):
+        if not self.use_viewdirs:
+            return super(FlexibleTrunkModel, self).evaluate_views(ray_points, view_directions)
+
+        # Trunk evaluated once, shared across the views
+        x = self.evaluate_trunk(ray_points)
+        feat = self.relu(self.fc_feat(x))
+        alpha = self.fc_alpha(x)
+
+        # The first direction layer splits into the shared feature part and the per view direction part
+        layer, feat_size = self.layers_dir[0], feat.shape[-1]
+        hidden = torch.nn.functional.linear(feat, layer.weight[:, :feat_size])
+        view = torch.nn.functional.linear(self.encode_dir(view_directions), layer.weight[:, feat_size:], layer.bias)
+
+        x = self.relu(hidden[..., None, :, :] + view[..., :, None, :])
+        for l in self.layers_dir[1:]:
+            x = self.relu(l(x))
+
+        rgb = torch.sigmoid(self.fc_rgb(x))
+        alpha = alpha[..., None, :, :].expand(*rgb.shape[:-1], 1)
+
+        return torch.cat((rgb, alpha), dim=-1)
+
+    def evaluate(self, ray_points, ray_directions=None):
+        x = self.evaluate_trunk(ray_points)
 
         if self.use_viewdirs:
+            # Directions either per sample or per ray, encoded once per ray in the latter
             view = self.encode_dir(ray_directions)
             feat = self.relu(self.fc_feat(x))
             alpha = self.fc_alpha(x)
-            x = torch.cat((feat, view), dim=-1)
+            x = torch.cat((feat, broadcast_ray_features(view, feat)), dim=-1)
             for l in self.layers_dir:
                 x = self.relu(l(x))
             rgb = torch.sigmoid(self.fc_rgb(x))
@@ -80,7 +156,36 @@ class FlexibleNeRFModel(torch.nn.Module):
             return x
 
 
-class SimpleModel(torch.nn.Module):
+class FlexibleNeRFModel(FlexibleTrunkModel):
+    def __init__(
+        self,
+        num_layers=4,
+        hidden_size=128,
+        skip_step=4,
+        num_encoding_fn_xyz=6,
+        num_encoding_fn_dir=4,
+        include_input_xyz=True,
+        include_input_dir=True,
+        log_sampling_xyz=True,
+        log_sampling_dir=True,
+        use_viewdirs=True,
+        checkpoint_layers=0,
+        checkpoint_segment=0,
+        **kwargs
+    ):
+        encode_xyz = PositionalEncoding(
+            num_encoding_fn_xyz, include_input_xyz, log_sampling_xyz
+        )
+        encode_dir = PositionalEncoding(
+            num_encoding_fn_dir, include_input_dir, log_sampling_dir
+        )
+        super(FlexibleNeRFModel, self).__init__(
+            encode_xyz, encode_dir, encode_dir.output_size(), num_layers, hidden_size, skip_step, use_viewdirs,
+            checkpoint_layers, checkpoint_segment
+        )
+
+
+class SimpleModel(CheckpointedModel):
     def __init__(
         self,
         num_layers=4,
@@ -94,9 +199,10 @@ class SimpleModel(torch.nn.Module):
         log_sampling_dir=True,
         skip_step=1,
         encoding="spatial",
+        checkpoint_segment=0,
         **kwargs
     ):
-        super(SimpleModel, self).__init__()
+        super(SimpleModel, self).__init__(checkpoint_segment)
         self.encode_xyz = get_encoding(encoding)(3, num_encoding_fn_xyz, 8)
         self.encode_dir = PositionalEncoding(
             num_encoding_fn_dir, include_input_dir, log_sampling_dir
@@ -119,19 +225,19 @@ class SimpleModel(torch.nn.Module):
                 num_layers_view,
             )
 
-    def forward(self, ray_points, ray_directions=None):
+    def evaluate(self, ray_points, ray_directions=None):
         xyz = self.encode_xyz(ray_points)
         x = self.layer0(xyz)
         x = self.hidden_all(x, xyz)
         depth = self.depth(x)
         if self.num_layers_view_amount >= 0 and ray_directions is not None:
-            xyzdir = torch.cat((xyz, self.encode_dir(ray_directions)), dim=-1)
+            xyzdir = torch.cat((xyz, broadcast_ray_features(self.encode_dir(ray_directions), xyz)), dim=-1)
             x = self.hidden_view(x, xyzdir)
         color = self.color(x)
         return torch.cat([color, depth], dim=-1)
 
 
-class SpecularSimpleModel(torch.nn.Module):
+class SpecularSimpleModel(CheckpointedModel):
     def __init__(
         self,
         num_layers=4,
@@ -145,9 +251,10 @@ class SpecularSimpleModel(torch.nn.Module):
         log_sampling_dir=True,
         skip_step=1,
         luminance_function="min1",
+        checkpoint_segment=0,
         **kwargs
     ):
-        super(SpecularSimpleModel, self).__init__()
+        super(SpecularSimpleModel, self).__init__(checkpoint_segment)
         self.encode_xyz = SpatialEmbedding(3, num_encoding_fn_xyz, 8)
         self.encode_dir = PositionalEncoding(
             num_encoding_fn_dir, include_input_dir, log_sampling_dir
@@ -173,25 +280,25 @@ class SpecularSimpleModel(torch.nn.Module):
             self.specular = SimpleModule(hidden_size, 1, activation=torch.nn.Tanh())
             self.combine = get_luminance_function(luminance_function)
 
-    def forward(self, ray_points, ray_directions=None):
+    def evaluate(self, ray_points, ray_directions=None):
         xyz = self.encode_xyz(ray_points)
         x = self.layer0(xyz)
         x = self.hidden_all(x, xyz)
         depth = self.depth(x)
         color = self.color(x)
         if self.num_layers_view_amount >= 0 and ray_directions is not None:
-            xyzdir = torch.cat((xyz, self.encode_dir(ray_directions)), dim=-1)
+            xyzdir = torch.cat((xyz, broadcast_ray_features(self.encode_dir(ray_directions), xyz)), dim=-1)
             x = self.hidden_view(x, xyzdir)
             specular = torch.nn.functional.relu(self.specular(x))
             color = self.combine(color, specular)
         return torch.cat([color, depth], dim=-1), specular
 
 
-class FlatModel(torch.nn.Module):
+class FlatModel(CheckpointedModel):
     def __init__(
-        self, hidden_size=256, num_layers=2, num_encoding_fn_xyz=128, **kwargs
+        self, hidden_size=256, num_layers=2, num_encoding_fn_xyz=128, checkpoint_segment=0, **kwargs
     ):
-        super(FlatModel, self).__init__()
+        super(FlatModel, self).__init__(checkpoint_segment)
         self.embed = FastRotPos(3, num_encoding_fn_xyz, 10)
         self.hidden_all = torch.nn.Sequential(
             SimpleModule(self.embed.output_size(), hidden_size),
@@ -201,7 +308,7 @@ class FlatModel(torch.nn.Module):
         self.depth = SimpleModule(hidden_size, 1)
         self.color = SimpleModule(hidden_size, 3, activation=torch.nn.Sigmoid())
 
-    def forward(self, ray_points, ray_directions=None):
+    def evaluate(self, ray_points, ray_directions=None):
         x = self.embed(ray_points)
         x = self.hidden_all(x)
         depth = self.depth(x)
@@ -209,11 +316,11 @@ class FlatModel(torch.nn.Module):
         return torch.cat([color, depth], dim=-1)
 
 
-class ResModel(torch.nn.Module):
+class ResModel(CheckpointedModel):
     def __init__(
-        self, hidden_size=128, num_layers=2, num_encoding_fn_xyz=128, **kwargs
+        self, hidden_size=128, num_layers=2, num_encoding_fn_xyz=128, checkpoint_segment=0, **kwargs
     ):
-        super(ResModel, self).__init__()
+        super(ResModel, self).__init__(checkpoint_segment)
         self.embed = SimpleSpatialEmbedding(3, num_encoding_fn_xyz, 8)
         self.model0 = SimpleModule(self.embed.output_size(), hidden_size)
         self.model1 = torch.nn.Sequential(
@@ -223,7 +330,7 @@ class ResModel(torch.nn.Module):
         self.depth = SimpleModule(hidden_size, 1)
         self.color = SimpleModule(hidden_size, 3, activation=torch.nn.Sigmoid())
 
-    def forward(self, ray_points, ray_directions=None):
+    def evaluate(self, ray_points, ray_directions=None):
         x = self.embed(ray_points)
         x_hat = self.model0(x)
         x = self.model1(x_hat)
@@ -232,7 +339,7 @@ class ResModel(torch.nn.Module):
         return torch.cat([color, depth], dim=-1)
 
 
-class DropModel(torch.nn.Module):
+class DropModel(CheckpointedModel):
     def __init__(
         self,
         num_layers=4,
@@ -246,9 +353,10 @@ class DropModel(torch.nn.Module):
         log_sampling_dir=True,
         skip_step=1,
         encoding="spatial",
+        checkpoint_segment=0,
         **kwargs
     ):
-        super(DropModel, self).__init__()
+        super(DropModel, self).__init__(checkpoint_segment)
         self.encode_xyz = get_encoding(encoding)(3, num_encoding_fn_xyz, 8)
         self.encode_dir = PositionalEncoding(
             num_encoding_fn_dir, include_input_dir, log_sampling_dir
@@ -272,20 +380,20 @@ class DropModel(torch.nn.Module):
                 num_layers_view,
             )
 
-    def forward(self, ray_points, ray_directions=None):
+    def evaluate(self, ray_points, ray_directions=None):
         xyz = self.encode_xyz(ray_points)
         x = self.layer0(xyz)
         x = self.hidden_all(x, xyz)
         x = self.drop(x)
         depth = self.depth(x)
         if self.num_layers_view_amount >= 0 and ray_directions is not None:
-            xyzdir = torch.cat((xyz, self.encode_dir(ray_directions)), dim=-1)
+            xyzdir = torch.cat((xyz, broadcast_ray_features(self.encode_dir(ray_directions), xyz)), dim=-1)
             x = self.hidden_view(x, xyzdir)
         color = self.color(x)
         return torch.cat([color, depth], dim=-1)
 
 
-class RotFlexibleNeRFModel(torch.nn.Module):
+class RotFlexibleNeRFModel(FlexibleTrunkModel):
     def __init__(
         self,
         num_layers=4,
@@ -297,70 +405,22 @@ class RotFlexibleNeRFModel(torch.nn.Module):
         log_sampling_dir=True,
         use_viewdirs=True,
         encoding="spatial",
+        checkpoint_layers=0,
+        checkpoint_segment=0,
         **kwargs
     ):
-        super(RotFlexibleNeRFModel, self).__init__()
-        self.encode_xyz = get_encoding(encoding)(
+        encode_xyz = get_encoding(encoding)(
             3, num_encoding_fn_xyz, 8
         )
-        self.encode_dir = PositionalEncoding(
+        encode_dir = PositionalEncoding(
             num_encoding_fn_dir, include_input_dir, log_sampling_dir
         )
 
         include_input_dir = 3 if include_input_dir else 0
-        self.dim_dir = include_input_dir + 2 * 3 * num_encoding_fn_dir
-        self.skip_step = skip_step
-        self.num_layers = num_layers
-        if not use_viewdirs:
-            self.dim_dir = 0
-
-        self.layer1 = torch.nn.Linear(self.encode_xyz.output_size(), hidden_size)
-        self.layers_xyz = torch.nn.ModuleList()
-        for i in range(num_layers - 1):
-            if i % self.skip_step == 0 and i > 0 and i != num_layers - 1:
-                self.layers_xyz.append(
-                    torch.nn.Linear(self.encode_xyz.output_size() + hidden_size, hidden_size)
-                )
-            else:
-                self.layers_xyz.append(torch.nn.Linear(hidden_size, hidden_size))
-
-        self.use_viewdirs = use_viewdirs
-        if self.use_viewdirs:
-            self.layers_dir = torch.nn.ModuleList()
-            # This deviates from the original paper, and follows the code release instead.
-            self.layers_dir.append(
-                torch.nn.Linear(self.dim_dir + hidden_size, hidden_size // 2)
-            )
-
-            self.fc_alpha = torch.nn.Linear(hidden_size, 1)
-            self.fc_rgb = torch.nn.Linear(hidden_size // 2, 3)
-            self.fc_feat = torch.nn.Linear(hidden_size, hidden_size)
-        else:
-            self.fc_out = torch.nn.Linear(hidden_size, 4)
-
-        self.relu = torch.nn.functional.relu
-
-    def forward(self, ray_points, ray_directions=None):
-        xyz = self.encode_xyz(ray_points)
-        x = self.layer1(xyz)
-        for i, layer in enumerate(self.layers_xyz):
-            if i % self.skip_step == 0 and i > 0 and i != self.num_layers - 1:
-                x = torch.cat((x, xyz), dim=-1)
-            x = self.relu(layer(x))
-
-        if self.use_viewdirs:
-            view = self.encode_dir(ray_directions)
-            feat = self.relu(self.fc_feat(x))
-            alpha = self.fc_alpha(x)
-
-            x = torch.cat((feat, view), dim=-1)
-            for l in self.layers_dir:
-                x = self.relu(l(x))
+        dim_dir = include_input_dir + 2 * 3 * num_encoding_fn_dir
+        super(RotFlexibleNeRFModel, self).__init__(
+            encode_xyz, encode_dir, dim_dir, num_layers, hidden_size, skip_step, use_viewdirs,
+            checkpoint_layers, checkpoint_segment
+        )
 
-            rgb = torch.sigmoid(self.fc_rgb(x))
 
-            return torch.cat((rgb, alpha), dim=-1)
-        else:
-            x = self.fc_out(x)
-            x[..., :3] = torch.sigmoid(x[..., :3])
-            return x
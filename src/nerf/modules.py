@@ -1,12 +1,46 @@
 import math
 import torch
 
-from nerf import cumprod_exclusive
+from nerf import composite_rays
 from dataclasses import dataclass
+from torch.utils.checkpoint import checkpoint
+from typing import List
+
+
+def fused_positional_encoding(x: torch.Tensor, frequency_bands: torch.Tensor, include_input: bool) -> torch.Tensor:
+    """ Positional encoding [x, sin(x * bands), cos(x * bands)] written into a single preallocated buffer,
+    without the expanded, product and concatenated intermediates. Exact up to the float rounding of the
+    reference encoding (max abs difference 0 in float32). Not differentiable with respect to x.
+    Args:
+        x (torch.Tensor): Tensor (...xD) of the inputs.
+        frequency_bands (torch.Tensor): Tensor (F) of the frequency bands.
+        include_input (bool): Whether the inputs are prepended.
+    Returns:
+        encoding (torch.Tensor): Tensor (...x(D + 2DF)), in the layout of the reference encoding.
+    """
+    shape = list(x.shape[:-1])
+    dims, bands = x.shape[-1], frequency_bands.shape[0]
+    offset = dims if include_input else 0
+
+    out = torch.empty(shape + [offset + 2 * dims * bands], dtype = x.dtype, device = x.device)
+    if include_input:
+        out[..., :dims] = x
+
+    # Views of the sin and cos parts, (...xDxF)
+    sin = out[..., offset:offset + dims * bands].view(shape + [dims, bands])
+    cos = out[..., offset + dims * bands:].view(shape + [dims, bands])
+
+    # Angles written into the cos part, sin is computed from them before cos is done in-place
+    torch.mul(x[..., None], frequency_bands, out = cos)
+    torch.sin(cos, out = sin)
+    cos.cos_()
+
+    return out
 
 
 class PositionalEncoding(torch.nn.Module):
     """Apply positional encoding to the input.
+    Inputs which do not require gradients take the fused path, see fused_positional_encoding.
     """
 
     def __init__(self, num_encoding_functions: int = 6, include_input: bool = True, log_sampling: bool = True):
@@ -24,12 +58,14 @@ class PositionalEncoding(torch.nn.Module):
         self.register_buffer("frequency_bands", frequency_bands)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if not x.requires_grad:
+            return fused_positional_encoding(x, self.frequency_bands, self.include_input)
 
-        input = [x] if self.include_input else []
+        input = [x] if self.include_input else torch.jit.annotate(List[torch.Tensor], [])
         xshape = list(x.shape)
-        x = x[..., None].expand(*xshape, self.num_encoding_functions)
+        x = x[..., None].expand(xshape + [self.num_encoding_functions])
         x = self.frequency_bands * x
-        x = x.view(*xshape[:-1], -1)
+        x = x.view(xshape[:-1] + [-1])
         encoding = torch.cat(input + [torch.sin(x), torch.cos(x)], dim = -1)
         return encoding
 
@@ -37,6 +73,43 @@ class PositionalEncoding(torch.nn.Module):
         return 2 * 3 * self.num_encoding_functions + (3 if self.include_input else 0)
 
 
+def broadcast_ray_features(features, samples):
+    """ Broadcasts per ray features (RxF) over the samples (RxSx...) of each ray, per sample features are kept. """
+    if features.dim() < samples.dim():
+        features = features[..., None, :].expand(*samples.shape[:-1], features.shape[-1])
+
+    return features
+
+
+def checkpoint_function(function, *inputs):
+    """ Gradient checkpoint of the function, its activations are recomputed during the backward pass instead of
+    being kept alive. The dummy input requiring grad keeps the parameter gradients flowing when none of the inputs
+    do, the None inputs are passed through.
+    """
+    present = [x is not None for x in inputs]
+
+    def run(dummy, *tensors):
+        tensors = iter(tensors)
+        return function(*[next(tensors) if flag else None for flag in present])
+
+    tensors = [x for x in inputs if x is not None]
+    dummy = torch.ones(1, device = tensors[0].device, requires_grad = True)
+    return checkpoint(run, dummy, *tensors)
+
+
+def checkpoint_segments(function, segment_size, *inputs):
+    """ Gradient checkpointed function over segments of the rays, the first dimension of the inputs. """
+    outputs = []
+    for start in range(0, inputs[0].shape[0], segment_size):
+        segment = [x[start:start + segment_size] if x is not None else None for x in inputs]
+        outputs.append(checkpoint_function(function, *segment))
+
+    if isinstance(outputs[0], tuple):
+        return tuple(torch.cat(output, 0) for output in zip(*outputs))
+
+    return torch.cat(outputs, 0)
+
+
 @dataclass
 class OutputBundle:
     rgb_map: torch.Tensor = None
@@ -70,6 +143,8 @@ class VolumeRenderer(torch.nn.Module):
         else:
             radiance_field_noise_std = self.val_radiance_field_noise_std
 
+        # Compositing in full precision, the radiance field may come from autocast queries
+        radiance_field, depth_values = radiance_field.float(), depth_values.float()
         dists = torch.cat(
             (
                 depth_values[..., 1:] - depth_values[..., :-1],
@@ -91,18 +166,83 @@ class VolumeRenderer(torch.nn.Module):
             )
 
         sigma_a = torch.nn.functional.relu(radiance_field[..., 3] + noise)
-        alpha = 1.0 - torch.exp(-sigma_a * dists)
+        rgb_map, depth_map, acc_map, weights, weight_attenuation = composite_rays(sigma_a * dists, rgb, depth_values)
+
+        return self.compose(rgb_map, depth_map, acc_map, weights, weight_attenuation)
+
+    @torch.no_grad()
+    def march(self, model, ray_points, depth_values, ray_directions, segment_size = 32, samples_mask = None):
+        """ Inference rendering with early ray termination, the samples are queried in segments along the rays
+        and the rays whose transmittance falls below the attenuation threshold are dropped before the next segment.
+        Args:
+            model (torch.nn.Module): Radiance field model queried with (points, directions).
+            ray_points (torch.Tensor): Tensor (RxSx3) of the samples across each ray.
+            depth_values (torch.Tensor): Tensor (RxS) of the sample depths.
+            ray_directions (torch.Tensor): Tensor (Rx3) of the ray directions.
+            segment_size (int): Number of samples per ray queried at once.
+            samples_mask (torch.Tensor): Optional mask (RxS) of the samples to query, the others are empty.
+        Returns:
+            bundle (OutputBundle): Same output as the forward pass, without the occluded samples.
+        """
+        ray_count, sample_count = depth_values.shape
+        depth_values = depth_values.float()
+        dists = torch.cat(
+            (
+                depth_values[..., 1:] - depth_values[..., :-1],
+                self.one_e_10.expand(depth_values[..., :1].shape),
+            ),
+            dim = -1,
+        ) * ray_directions[..., None, :].norm(p = 2, dim = -1)
 
-        weight_attenuation = cumprod_exclusive(1.0 - alpha + 1e-10)
-        mask_weights = (weight_attenuation > self.attenuation_threshold).float()
-        weights = alpha * weight_attenuation
+        rgb_map = torch.zeros(ray_count, 3, device = ray_points.device)
+        weights = torch.zeros_like(depth_values)
+        weight_attenuation = torch.zeros_like(depth_values)
+
+        # Rays still visible and their optical depth
+        active = torch.arange(ray_count, device = ray_points.device)
+        optical_depth = torch.zeros(ray_count, device = ray_points.device)
+        for start in range(0, sample_count, segment_size):
+            segment = slice(start, start + segment_size)
+            points = ray_points[active, segment]
+            directions = ray_directions[active]
+
+            # Query only the masked samples of the segment
+            if samples_mask is None:
+                radiance_field = model(points, directions).float()
+            else:
+                mask = samples_mask[active, segment]
+                radiance_field = torch.zeros(*points.shape[:-1], 4, device = points.device)
+                if mask.any():
+                    directions = broadcast_ray_features(directions, points)
+                    radiance_field[mask] = model(points[mask], directions[mask]).float()
+
+            sigma_delta = torch.nn.functional.relu(radiance_field[..., 3]) * dists[active, segment]
+
+            # Attenuation continues from the previous segment
+            segment_rgb, _, _, segment_weights, segment_attenuation = composite_rays(
+                sigma_delta, radiance_field[..., :3], depth_values[active, segment], optical_depth
+            )
 
-        rgb_map = weights[..., None] * rgb
-        rgb_map = rgb_map.sum(dim = -2)
+            weights[active, segment] = segment_weights
+            weight_attenuation[active, segment] = segment_attenuation
+            rgb_map[active] += segment_rgb
 
-        acc_map = weights.sum(dim = -1)
+            # Compact the rays which are still visible
+            optical_depth = optical_depth + sigma_delta.sum(dim = -1)
+            mask_visible = torch.exp(-optical_depth) > self.attenuation_threshold
+            active, optical_depth = active[mask_visible], optical_depth[mask_visible]
+            if active.shape[0] == 0:
+                break
 
+        # The terminated rays are opaque, the others keep their residual transmittance
+        acc_map = torch.ones(ray_count, device = ray_points.device)
+        acc_map[active] = 1.0 - torch.exp(-optical_depth)
         depth_map = (weights * depth_values).sum(dim = -1)
+
+        return self.compose(rgb_map, depth_map, acc_map, weights, weight_attenuation)
+
+    def compose(self, rgb_map, depth_map, acc_map, weights, weight_attenuation):
+        mask_weights = (weight_attenuation > self.attenuation_threshold).float()
         disp_map = 1.0 / torch.max(1e-10 * torch.ones_like(depth_map), depth_map / acc_map)
         disp_map[torch.isnan(disp_map)] = 0
         if not self.training:
@@ -129,6 +269,7 @@ class DensityExtractor(torch.nn.Module):
         self.register_buffer("one_e_10", one_e_10)
 
     def forward(self, radiance_field, depth_values, ray_directions):
+        radiance_field, depth_values = radiance_field.float(), depth_values.float()
         dists = torch.cat(
             (
                 depth_values[..., 1:] - depth_values[..., :-1],
@@ -139,8 +280,7 @@ class DensityExtractor(torch.nn.Module):
         dists = dists * ray_directions[..., None, :].norm(p = 2, dim = -1)
 
         sigma_a = torch.nn.functional.relu(radiance_field[..., 3])
-        alpha = 1.0 - torch.exp(-sigma_a * dists)
-        weights = alpha * cumprod_exclusive(1.0 - alpha + 1e-10)
+        _, _, _, weights, _ = composite_rays(sigma_a * dists, radiance_field[..., :3], depth_values)
 
         return weights
 
@@ -186,6 +326,70 @@ class RaySampleInterval(torch.nn.Module):
         return point_intervals
 
 
+class OccupancyGrid(torch.nn.Module):
+    """Dense low resolution grid of decayed density maxima, used to skip the samples falling into empty space.
+    """
+
+    def __init__(self, resolution = 64, limit = 1.5, threshold = 0.01, samples_per_cell = 4, decay = 0.95, chunksize = 65536):
+        super(OccupancyGrid, self).__init__()
+        self.resolution = resolution
+        self.limit = limit
+        self.threshold = threshold
+        self.samples_per_cell = samples_per_cell
+        self.decay = decay
+        self.chunksize = chunksize
+
+        # Every cell is occupied until the first update
+        density = torch.full((resolution,) * 3, float("inf"))
+        self.register_buffer("density", density)
+
+    def forward(self, points):
+        """ Returns the mask of the points (..., 3) falling into occupied cells. """
+        cells = ((points + self.limit) / (2 * self.limit) * self.resolution).floor().long()
+        mask_inside = ((cells >= 0) & (cells < self.resolution)).all(-1)
+
+        cells = cells.clamp(0, self.resolution - 1)
+        mask_occupied = self.density[cells[..., 0], cells[..., 1], cells[..., 2]] > self.threshold
+
+        return mask_inside & mask_occupied
+
+    @torch.no_grad()
+    def update(self, model):
+        """ Refreshes the density maxima by querying the model on jittered samples within each cell. The previous
+        maxima decay rather than being overwritten, such that a cell missed by the samples of one update stays occupied.
+        """
+        grid = torch.arange(self.resolution, dtype = torch.float, device = self.density.device)
+        cells = torch.stack(torch.meshgrid(grid, grid, grid), -1).view(-1, 3)
+
+        density = torch.zeros(cells.shape[0], device = self.density.device)
+        for _ in range(self.samples_per_cell):
+            for i in range(0, cells.shape[0], self.chunksize):
+                chunk_slice = slice(i, i + self.chunksize)
+
+                # Random samples within the cells
+                points = (cells[chunk_slice] + torch.rand_like(cells[chunk_slice])) / self.resolution
+                points = (2 * points - 1) * self.limit
+
+                # The density doesn't depend on the view, any unit direction will do
+                directions = torch.nn.functional.normalize(torch.randn_like(points), dim = -1)
+
+                radiance_field = model(points, directions)
+                if isinstance(radiance_field, tuple):
+                    radiance_field = radiance_field[0]
+
+                sigma_a = torch.nn.functional.relu(radiance_field[..., 3])
+                density[chunk_slice] = torch.max(density[chunk_slice], sigma_a)
+
+        # Decayed running maxima, the cells are replaced on the first update
+        density = density.view(self.density.shape)
+        density = torch.where(torch.isinf(self.density), density, torch.max(self.decay * self.density, density))
+        self.density.copy_(density)
+
+    def occupancy(self):
+        """ Fraction of the occupied cells. """
+        return (self.density > self.threshold).float().mean()
+
+
 class SamplePDF(torch.nn.Module):
     def __init__(self, num_samples):
         super(SamplePDF, self).__init__()
@@ -210,7 +414,8 @@ class SamplePDF(torch.nn.Module):
         by yenchenlin (https://github.com/yenchenlin/nerf-pytorch).
         """
 
-        weights = weights + 1e-5
+        # CDF inversion in full precision
+        bins, weights = bins.float(), weights.float() + 1e-5
         pdf = weights / torch.sum(weights, dim = -1, keepdim = True)
         cdf = torch.cumsum(pdf, dim = -1)
         cdf = torch.cat(
@@ -500,6 +705,7 @@ class FastRotPos(torch.nn.Module):
 
 class FlexiblePositionalEncoding(torch.nn.Module):
     """Apply positional encoding to the input.
+    Inputs which do not require gradients take the fused path, see fused_positional_encoding.
     """
 
     def __init__(self, in_features, out_features, weight_multiplier = 1.0):
@@ -508,11 +714,16 @@ class FlexiblePositionalEncoding(torch.nn.Module):
         frequency_bands = 2.0 ** torch.linspace(
             0.0, weight_multiplier, out_features
         )
+        self.register_buffer("frequencies", frequency_bands, persistent = False)
+
         frequency_bands = (torch.eye(in_features)[..., None] * frequency_bands).view(in_features, -1)
         self.register_buffer("frequency_bands", frequency_bands)
         self.in_features = in_features
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if not x.requires_grad:
+            return fused_positional_encoding(x, self.frequencies, True)
+
         out = torch.matmul(x, self.frequency_bands)
         encoding = torch.cat([x, torch.sin(out), torch.cos(out)], dim = -1)
         return encoding
@@ -1,8 +1,11 @@
+import json
+import contextlib
 import torch
 import numpy as np
 import torchvision
 
 from tqdm import tqdm
+from nerf.export import export_obj
 
 POINT_GROUND_TRUTH = torch.tensor([ 0., 0., 255. ])
 POINT_OUT_TRUE = torch.tensor([ 0., 255., 0. ])
@@ -83,34 +86,6 @@ def comp_depth(depth_output, depth_target, empty_value = 0.):
     return depth_loss, depth_empty, depth_space, depth_l1
 
 
-def export_obj(vertices, triangles, diffuse, normals, filename):
-    """
-    Exports a mesh in the (.obj) format.
-    """
-    print('Writing to obj...')
-
-    with open(filename, "w") as fh:
-
-        for index, v in enumerate(vertices):
-            fh.write("v {} {} {}".format(*v))
-            if len(diffuse) > index:
-                fh.write(" {} {} {}".format(*diffuse[index]))
-
-            fh.write("\n")
-
-        for n in normals:
-            fh.write("vn {} {} {}\n".format(*n))
-
-        for f in triangles:
-            fh.write("f")
-            for index in f:
-                fh.write(" {}//{}".format(index + 1, index + 1))
-
-            fh.write("\n")
-
-    print(f"Finished writing to {filename} with {len(vertices)} vertices")
-
-
 def batchify(*data, batch_size=1024, device="cpu", progress=True):
     assert all(sample is None or sample.shape[0] == data[0].shape[0] for sample in data), \
         "Sizes of tensors must match for dimension 0."
@@ -139,6 +114,53 @@ def batchify(*data, batch_size=1024, device="cpu", progress=True):
     return tqdm(iterator, total=total)
 
 
+def create_memmap_arrays(path, layout, meta = None, alignment = 64):
+    """ Creates a single raw binary file (.bin) holding the arrays and its JSON index (.json).
+    Args:
+        path (str): Path without extension.
+        layout (dict): Array name mapped to its (shape, dtype).
+        meta (dict): Extra properties stored within the index.
+    Returns:
+        arrays (dict): Writable memory-mapped arrays.
+    """
+    index, offset = {}, 0
+    for name, (shape, dtype) in layout.items():
+        dtype = np.dtype(dtype)
+        index[name] = {"offset": offset, "dtype": dtype.str, "shape": list(shape)}
+
+        # Aligned offsets for the following array
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        offset += (nbytes + alignment - 1) // alignment * alignment
+
+    with open(f"{path}.json", "w") as fh:
+        json.dump({"arrays": index, "meta": meta or {}}, fh, indent = 2)
+
+    with open(f"{path}.bin", "wb") as fh:
+        fh.truncate(offset)
+
+    return load_memmap_arrays(path, mode = "r+")[0]
+
+
+def load_memmap_arrays(path, mode = "r"):
+    """ Memory-maps the arrays of a file created by create_memmap_arrays, only the accessed pages are read.
+    Returns:
+        arrays (dict): Memory-mapped arrays.
+        meta (dict): Extra properties stored within the index.
+    """
+    with open(f"{path}.json", "r") as fh:
+        index = json.load(fh)
+
+    arrays = {}
+    for name, props in index["arrays"].items():
+        shape = tuple(props["shape"])
+        if np.prod(shape) == 0:
+            arrays[name] = np.empty(shape, dtype = props["dtype"])
+        else:
+            arrays[name] = np.memmap(f"{path}.bin", dtype = props["dtype"], mode = mode, offset = props["offset"], shape = shape)
+
+    return arrays, index["meta"]
+
+
 def export_point_cloud(it, ray_origins, ray_directions, depth_fine, dep_target):
     vertices_output = (ray_origins + ray_directions * depth_fine[..., None]).view(-1, 3)
     vertices_target = (ray_origins + ray_directions * dep_target[..., None]).view(-1, 3)
@@ -196,6 +218,29 @@ def meshgrid_xy(
     return ii.transpose(-1, -2), jj.transpose(-1, -2)
 
 
+def autocast(precision, device):
+    """ Autocast context of the MLP queries, a no-op at full precision.
+    Args:
+        precision (str): Either 32, 16 for half or bf16 for bfloat16 activations.
+        device (torch.device): Device of the queries, the CPU autocast only supports bfloat16.
+    Returns:
+        context: Autocast context manager.
+    """
+    precision = str(precision)
+    if precision == "32":
+        return contextlib.nullcontext()
+
+    dtype = torch.bfloat16 if precision == "bf16" or device.type == "cpu" else torch.float16
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device.type, dtype = dtype)
+
+    # Older releases only autocast to half precision on the GPU
+    if device.type == "cuda" and dtype == torch.float16:
+        return torch.cuda.amp.autocast()
+
+    return contextlib.nullcontext()
+
+
 def cumprod_exclusive(tensor: torch.Tensor) -> torch.Tensor:
     r"""Mimick functionality of tf.math.cumprod(..., exclusive=True), as it isn't available in PyTorch.
 
@@ -223,6 +268,79 @@ def cumprod_exclusive(tensor: torch.Tensor) -> torch.Tensor:
     return cumprod
 
 
+def log_transmittance(sigma_delta, optical_offset):
+    # Transmittance past and up to each sample from a single cumulative optical depth
+    transmittance = torch.exp(-(torch.cumsum(sigma_delta, dim = -1) + optical_offset[..., None]))
+    attenuation = torch.cat((torch.exp(-optical_offset)[..., None], transmittance[..., :-1]), dim = -1)
+
+    # Telescoping weights, T(i) * alpha(i) = T(i) - T(i + 1)
+    weights = attenuation - transmittance
+
+    return transmittance, attenuation, weights
+
+
+class LogTransmittanceCompositing(torch.autograd.Function):
+    """ Alpha compositing in log transmittance space. Only the inputs are kept for the backward pass, where the
+    transmittance is recomputed, such that none of the per sample intermediates stay alive in between.
+    """
+
+    @staticmethod
+    def forward(ctx, sigma_delta, rgb, depth_values, optical_offset):
+        transmittance, attenuation, weights = log_transmittance(sigma_delta, optical_offset)
+
+        rgb_map = (weights[..., None] * rgb).sum(dim = -2)
+        depth_map = (weights * depth_values).sum(dim = -1)
+        acc_map = attenuation[..., 0] - transmittance[..., -1]
+
+        ctx.save_for_backward(sigma_delta, rgb, depth_values, optical_offset)
+        ctx.mark_non_differentiable(attenuation)
+
+        return rgb_map, depth_map, acc_map, weights, attenuation
+
+    @staticmethod
+    def backward(ctx, grad_rgb_map, grad_depth_map, grad_acc_map, grad_weights, grad_attenuation):
+        sigma_delta, rgb, depth_values, optical_offset = ctx.saved_tensors
+        transmittance, _, weights = log_transmittance(sigma_delta, optical_offset)
+
+        # Gradient with respect to each weight
+        grad = grad_weights + (grad_rgb_map[..., None, :] * rgb).sum(dim = -1)
+        grad = grad + grad_depth_map[..., None] * depth_values + grad_acc_map[..., None]
+
+        # d w(i) / d s(k) = T(i) for i = k and -w(i) for i > k
+        # Reverse cumsum, the last sample is exactly zero against the far sentinel distance
+        grad_weighted = grad * weights
+        grad_weighted_after = torch.cumsum(grad_weighted.flip(-1), dim = -1).flip(-1) - grad_weighted
+        grad_sigma_delta = transmittance * grad - grad_weighted_after
+
+        grad_rgb, grad_depth_values = None, None
+        if ctx.needs_input_grad[1]:
+            grad_rgb = grad_rgb_map[..., None, :] * weights[..., None]
+        if ctx.needs_input_grad[2]:
+            grad_depth_values = grad_depth_map[..., None] * weights
+
+        return grad_sigma_delta, grad_rgb, grad_depth_values, None
+
+
+def composite_rays(sigma_delta, rgb, depth_values, optical_offset = None):
+    """ Volume rendering of the samples along each ray, from a single cumulative sum of the optical depth.
+    Args:
+        sigma_delta (torch.Tensor): Tensor (RxS) of the density times the distance of each sample.
+        rgb (torch.Tensor): Tensor (RxSx3) of the sample colours.
+        depth_values (torch.Tensor): Tensor (RxS) of the sample depths.
+        optical_offset (torch.Tensor): Optional tensor (R) of the optical depth in front of the first sample.
+    Returns:
+        rgb_map (torch.Tensor): Tensor (Rx3) of the composited colours.
+        depth_map (torch.Tensor): Tensor (R) of the expected depths.
+        acc_map (torch.Tensor): Tensor (R) of the accumulated opacity.
+        weights (torch.Tensor): Tensor (RxS) of the sample weights.
+        attenuation (torch.Tensor): Tensor (RxS) of the transmittance in front of each sample.
+    """
+    if optical_offset is None:
+        optical_offset = sigma_delta.new_zeros(sigma_delta.shape[:-1])
+
+    return LogTransmittanceCompositing.apply(sigma_delta, rgb, depth_values, optical_offset)
+
+
 def get_ray_bundle(
         height: int,
         width: int,
@@ -1,39 +1,22 @@
 import torch
 
+from dataclasses import dataclass
 
-class Node:
-    def __init__(self, config, bounds, depth):
-        self.config = config
-        self.bounds = bounds
-        self.depth = depth
-        self.max_depth = self.config.tree.max_depth
-        if self.depth == 0:
-            self.count = self.config.tree.subdivision_outer_count
-        else:
-            self.count = self.config.tree.subdivision_inner_count
-
-        self.weight = 0.
-        self.sparse = True
-        self.children = []
-
-    def subdivide(self):
-        if self.depth >= self.max_depth:
-            return
 
-        offset = self.bounds[1] - self.bounds[0]
-        for i in range(0, self.count):
-            for g in range(0, self.count):
-                for h in range(0, self.count):
-                    ind1 = torch.tensor([i, g, h], dtype = torch.float) / self.count * offset
-                    ind2 = torch.tensor([i + 1, g + 1, h + 1], dtype = torch.float) / self.count * offset
+@dataclass
+class RayVoxelHits:
+    """ Compact (CSR) layout of the ray-voxel crossings, hits of the i-th ray are stored
+    in the range [ray_offsets[i], ray_offsets[i + 1]) ordered by the entry scalar.
+    """
+    ray_offsets: torch.Tensor = None
+    ray_indices: torch.Tensor = None
+    voxel_indices: torch.Tensor = None
+    t_in: torch.Tensor = None
+    t_out: torch.Tensor = None
 
-                    bounds = self.bounds[0] + ind1, self.bounds[0] + ind2
-                    child = Node(self.config, bounds, self.depth + 1)
-
-                    self.children.append(child)
-
-    def clear(self):
-        self.children = []
+    @property
+    def ray_counts(self):
+        return self.ray_offsets[1:] - self.ray_offsets[:-1]
 
 
 class TreeSampling:
@@ -75,18 +58,32 @@ class TreeSampling:
         # Initial bounds, normalized
         self.ray_near, self.ray_far = self.config.dataset.near, self.config.dataset.far
         self.ray_mean = (self.ray_near + self.ray_far) / 2
-        bounds = torch.tensor([self.ray_near - self.ray_mean] * 3), torch.tensor([self.ray_far - self.ray_mean] * 3)
+        bounds = torch.tensor([[self.ray_near - self.ray_mean] * 3, [self.ray_far - self.ray_mean] * 3])
 
-        # Tree root
-        self.root = Node(self.config, bounds, 0)
-        self.root.subdivide()
+        # Flat tree (struct of arrays), node 0 is the root and the children of a node are
+        # stored contiguously starting from its child offset (-1 for leaves).
+        self.nodes_bounds = bounds[None].to(self.device)
+        self.nodes_depths = torch.zeros(1, dtype = torch.long, device = self.device)
+        self.nodes_parents = torch.full((1,), -1, dtype = torch.long, device = self.device)
+        self.nodes_children = torch.full((1,), -1, dtype = torch.long, device = self.device)
+        self.nodes_weights = torch.zeros(1, device = self.device)
+
+        # Tree leaves, nodes used as voxels
+        self.leaves = torch.zeros(1, dtype = torch.long, device = self.device)
+        if self.config.tree.max_depth > 0:
+            self.leaves = self.subdivide(self.leaves, self.config.tree.subdivision_outer_count)
 
         # Tensor (Nx2x3) whose elements define the min/max bounds.
         self.voxels = None
 
-        # Tree residual data
+        # Outer grid cells to voxels mapping (CSR) used by the sparse traversal
+        self.cells_offsets = None
+        self.cells_voxels = None
+
+        # Tree residual data, running mean, sum of squared deviations (variance) and sample count of the voxel weights
         self.memm = None
-        self.counter = 1
+        self.memm_m2 = None
+        self.memm_counts = None
 
         # Initialize
         self.consolidate()
@@ -101,78 +98,179 @@ class TreeSampling:
 
         return False
 
-    def flatten(self):
-        vertices = []
-        faces = []
-        colors = []
-        for node in self.root.children:
-            offset = node.bounds[1] - node.bounds[0]
-            offset_index = len(vertices)
+    def subdivide(self, nodes, count):
+        """ Appends the count^3 children of each node to the tree.
+        Args:
+            nodes (torch.Tensor): Tensor (K) of the node indices to subdivide.
+            count (int): Subdivision count per axis.
+        Returns:
+            children (torch.Tensor): Tensor (K * count^3) of the children indices, grouped by parent.
+        """
+        children_count = count ** 3
 
-            for t in range(8):
-                tt = node.bounds[0].clone()
-                tt[TreeSampling.vertex_indices[t]] += offset[TreeSampling.vertex_indices[t]]
+        # Children offsets within the parent bounds, (i, g, h) ordered
+        grid = torch.arange(count, dtype = torch.float, device = self.device)
+        grid = torch.stack(torch.meshgrid(grid, grid, grid), -1).view(-1, 3)
 
-                vertices.append(tt)
+        bounds = self.nodes_bounds[nodes]
+        offset = (bounds[:, 1] - bounds[:, 0])[:, None, :]
+        bounds_min = bounds[:, 0][:, None, :] + grid / count * offset
+        bounds_max = bounds[:, 0][:, None, :] + (grid + 1) / count * offset
+        bounds = torch.stack((bounds_min, bounds_max), 2).view(-1, 2, 3)
 
-            colors.append(TreeSampling.colors_tensor)
-            faces.append(torch.tensor(TreeSampling.faces_indices) + offset_index)
+        nodes_count = self.nodes_bounds.shape[0]
+        children = torch.arange(nodes_count, nodes_count + bounds.shape[0], device = self.device)
+        self.nodes_children[nodes] = children[::children_count]
+
+        self.nodes_bounds = torch.cat((self.nodes_bounds, bounds), 0)
+        self.nodes_depths = torch.cat((self.nodes_depths, self.nodes_depths[nodes].repeat_interleave(children_count) + 1), 0)
+        self.nodes_parents = torch.cat((self.nodes_parents, nodes.repeat_interleave(children_count)), 0)
+        self.nodes_children = torch.cat((self.nodes_children, torch.full_like(children, -1)), 0)
+        self.nodes_weights = torch.cat((self.nodes_weights, torch.zeros(children.shape[0], device = self.device)), 0)
+
+        return children
+
+    def flatten(self):
+        voxels = self.voxels.cpu()
+        voxels_count = voxels.shape[0]
 
-        vertices = torch.stack(vertices, 0)
-        faces = torch.stack(faces, 0).view(-1, 3).int()
-        colors = torch.stack(colors, 0).view(-1, 3)
+        # Corners of each voxel as min bound offset on the selected axes
+        corners = torch.tensor([[axis in indices for axis in range(3)] for indices in TreeSampling.vertex_indices])
+        offset = voxels[:, 1] - voxels[:, 0]
+        vertices = voxels[:, None, 0] + corners * offset[:, None, :]
 
-        return vertices, faces, colors
+        faces = torch.tensor(TreeSampling.faces_indices).view(-1, 3)
+        faces = faces[None] + 8 * torch.arange(voxels_count)[:, None, None]
+        colors = TreeSampling.colors_tensor.expand(voxels_count, -1, -1)
 
-    def consolidate(self, split = False):
+        return vertices.view(-1, 3), faces.view(-1, 3).int(), colors.reshape(-1, 3)
+
+    def consolidate(self):
         if self.memm is not None:
             print(f"Min memm {self.memm.min()}")
             print(f"Max memm {self.memm.max()}")
             print(f"Mean memm {self.memm.mean()}")
             print(f"Median memm {self.memm.median()}")
+            print(f"Mean memm variance {self.memm_variance.mean()}")
             print(f"Threshold {self.config.tree.eps}")
 
-            # Filtering
-            voxels_indices = torch.arange(self.memm.shape[0])
-            mask_voxels = self.memm > self.config.tree.eps
-            mask_voxels_list = voxels_indices[mask_voxels].tolist()
-            inv_weights = (1.0 - self.memm[mask_voxels]).tolist()
+            # Keep track of the latest weights
+            self.nodes_weights[self.leaves] = self.memm
+
+            # Filtering, the voxels whose weight is uncertain are given the benefit of the doubt
+            eps_std = self.config.tree.get("eps_std", 0.0)
+            mask_voxels = self.memm + eps_std * self.memm_variance.sqrt() > self.config.tree.eps
+            voxels = self.leaves[mask_voxels]
+            inv_weights = 1.0 - self.memm[mask_voxels]
 
-            voxel_count_initial = voxels_indices.shape[0]
+            voxel_count_initial = self.leaves.shape[0]
             voxel_count_filtered = (~mask_voxels).sum()
-            voxel_count_current = len(mask_voxels_list)
+            voxel_count_current = voxels.shape[0]
             print(f"From {voxel_count_initial} voxels with {voxel_count_filtered} filtered to current {voxel_count_current}")
 
-            # Nodes closer to the root with high weight have higher priority
-            voxels_filtered = [ self.root.children[index] for index in mask_voxels_list ]
-            voxels_filtered = sorted(enumerate(voxels_filtered), key = lambda item: (item[1].depth, inv_weights[item[0]]))
-            voxels_filtered = [ item[1] for item in voxels_filtered ]
-
-            inner_size = self.config.tree.subdivision_inner_count ** 3 - 1
-
-            children = []
-            for index, child in enumerate(voxels_filtered):
-                # Check if exceeds max cap
-                exp_voxel_count = len(children) + inner_size + voxel_count_current - index
-                if exp_voxel_count < self.config.tree.max_voxel_count:
-                    child.subdivide()
-                    if len(child.children) > 0:
-                        children += child.children
-                    else:
-                        children.append(child)
-                else:
-                    children.append(child)
-
-            print(f"Now {len(children)} voxels")
-            self.root.children = children
-
-        self.voxels = [ torch.stack(node.bounds, 0) for node in self.root.children ]
-        if len(self.voxels) == 0:
+            # Nodes closer to the root with high weight have higher priority, ties keep their order
+            _, inv_ranks = torch.unique(inv_weights, return_inverse = True)
+            priority = self.nodes_depths[voxels] * voxel_count_current + inv_ranks
+            priority = priority * voxel_count_current + torch.arange(voxel_count_current, device = self.device)
+            voxels = voxels[priority.argsort()]
+
+            inner_count = self.config.tree.subdivision_inner_count
+            inner_size = inner_count ** 3 - 1
+
+            # Subdivide in priority order as long as the expected voxel count doesn't exceed the max cap
+            subdivisible = self.nodes_depths[voxels] < self.config.tree.max_depth
+            ranks = subdivisible.long().cumsum(0) - 1
+            capacity = self.config.tree.max_voxel_count - inner_size - voxel_count_current
+            mask_subdivide = subdivisible & (ranks * inner_size < capacity)
+
+            children = self.subdivide(voxels[mask_subdivide], inner_count)
+
+            # Replace each subdivided voxel by its children, in place
+            counts = torch.ones_like(voxels)
+            counts[mask_subdivide] = inner_size + 1
+            offsets = counts.cumsum(0) - counts
+
+            leaves = torch.empty(int(counts.sum()), dtype = torch.long, device = self.device)
+            leaves[offsets[~mask_subdivide]] = voxels[~mask_subdivide]
+            children_offsets = offsets[mask_subdivide].repeat_interleave(inner_size + 1)
+            children_offsets += torch.arange(inner_size + 1, device = self.device).repeat(int(mask_subdivide.sum()))
+            leaves[children_offsets] = children
+
+            print(f"Now {leaves.shape[0]} voxels")
+            self.leaves = leaves
+            self.compact()
+
+        self.voxels = self.nodes_bounds[self.leaves]
+        if self.voxels.shape[0] == 0:
             print(f"The chosen threshold {self.config.tree.eps} was set too high!")
 
-        self.voxels = torch.stack(self.voxels, 0).to(self.device)
         self.memm = torch.zeros(self.voxels.shape[0], ).to(self.device)
-        self.counter = 1
+        self.memm_m2 = torch.zeros_like(self.memm)
+        self.memm_counts = torch.zeros_like(self.memm)
+
+        self.build_cells()
+
+    def compact(self):
+        """ Drops the pruned nodes from the tree arrays and reindexes the remaining ones. A group of siblings is
+        kept whole as long as one of them is still a leaf or an ancestor of a leaf, such that the children stay contiguous.
+        """
+        nodes_count = self.nodes_bounds.shape[0]
+
+        # Leaves and their ancestors
+        alive = torch.zeros(nodes_count, dtype = torch.bool, device = self.device)
+        alive[self.leaves] = True
+        ancestors = self.nodes_parents[self.leaves]
+        while ancestors.shape[0] > 0:
+            alive[ancestors] = True
+            ancestors = self.nodes_parents[ancestors].unique()
+            ancestors = ancestors[ancestors >= 0]
+
+        # Sibling groups with an alive node
+        groups = torch.zeros(nodes_count, dtype = torch.bool, device = self.device)
+        groups[self.nodes_parents[alive & (self.nodes_parents >= 0)]] = True
+        keep = alive | ((self.nodes_parents >= 0) & groups[self.nodes_parents.clamp(min = 0)])
+        keep[0] = True
+
+        if keep.all():
+            return
+
+        remap = torch.full((nodes_count,), -1, dtype = torch.long, device = self.device)
+        remap[keep] = torch.arange(int(keep.sum()), device = self.device)
+
+        parents, children = self.nodes_parents[keep], self.nodes_children[keep]
+        self.nodes_bounds = self.nodes_bounds[keep]
+        self.nodes_depths = self.nodes_depths[keep]
+        self.nodes_weights = self.nodes_weights[keep]
+        self.nodes_parents = torch.where(parents >= 0, remap[parents.clamp(min = 0)], parents)
+        self.nodes_children = torch.where(children >= 0, remap[children.clamp(min = 0)], children)
+        self.leaves = remap[self.leaves]
+
+        print(f"Compacted the tree from {nodes_count} to {self.nodes_bounds.shape[0]} nodes")
+
+    def build_cells(self):
+        """ Bins the voxels by the outer grid cells they overlap, such that a cell lists its voxels. """
+        outer_count = self.config.tree.subdivision_outer_count
+        bounds_min, bounds_max = self.nodes_bounds[0]
+        cell_size = (bounds_max - bounds_min) / outer_count
+
+        # Range of the overlapped cells per axis, shrunk by a tolerance so that shared faces don't count
+        tolerance = 1e-4
+        cells_min = ((self.voxels[:, 0] - bounds_min) / cell_size + tolerance).floor().long().clamp(0, outer_count - 1)
+        cells_max = ((self.voxels[:, 1] - bounds_min) / cell_size - tolerance).floor().long().clamp(0, outer_count - 1)
+        cells_max = torch.max(cells_max, cells_min)
+        spans = cells_max - cells_min + 1
+
+        # Register each voxel in every cell of its range
+        counts = spans.prod(-1)
+        voxels = torch.repeat_interleave(torch.arange(counts.shape[0], device = self.device), counts)
+        local = torch.arange(voxels.shape[0], device = self.device) - (counts.cumsum(0) - counts)[voxels]
+        spans = spans[voxels]
+        cells = cells_min[voxels] + torch.stack((local // (spans[:, 1] * spans[:, 2]), local // spans[:, 2] % spans[:, 1], local % spans[:, 2]), -1)
+        cells = (cells[:, 0] * outer_count + cells[:, 1]) * outer_count + cells[:, 2]
+
+        counts = torch.bincount(cells, minlength = outer_count ** 3)
+        self.cells_offsets = torch.cat((counts.new_zeros(1), counts.cumsum(0)))
+        self.cells_voxels = voxels[cells.argsort()]
 
     def ray_batch_integration(self, step, ray_voxel_indices, ray_batch_weights, ray_batch_weights_mask):
         """ Performs ray batch integration into the nodes by weight accumulation
@@ -188,22 +286,24 @@ class TreeSampling:
             print(f"Began ray batch integration... Step:{step}")
 
         voxel_count = self.voxels.shape[0]
-        ray_count, ray_samples_count = ray_batch_weights.shape
 
-        # accumulate weights
-        acc = torch.zeros(ray_count, voxel_count, device = self.device)
-        acc = acc.scatter_add(-1, ray_voxel_indices, ray_batch_weights)
-        acc = acc.sum(0)
-
-        # freq weights
-        freq = torch.zeros(ray_count, voxel_count, device = self.device)
-        freq = freq.scatter_add(-1, ray_voxel_indices, ray_batch_weights_mask)
-        freq = freq.sum(0)
+        # accumulate weights and freq weights straight into the voxels
+        ray_voxel_indices = ray_voxel_indices.reshape(-1)
+        acc = torch.zeros(voxel_count, device = self.device).index_add_(0, ray_voxel_indices, ray_batch_weights.reshape(-1))
+        freq = torch.zeros(voxel_count, device = self.device).index_add_(0, ray_voxel_indices, ray_batch_weights_mask.reshape(-1))
         mask = freq > 0
 
-        # distribute weights (voxel/accumulations) while being numerically stable
-        self.memm[mask] += (acc[mask] / freq[mask] - self.memm[mask]) / self.counter
-        self.counter += 1
+        # distribute weights (voxel/accumulations) while being numerically stable (Welford)
+        values = acc[mask] / freq[mask]
+        self.memm_counts[mask] += 1
+        delta = values - self.memm[mask]
+        self.memm[mask] += delta / self.memm_counts[mask]
+        self.memm_m2[mask] += delta * (values - self.memm[mask])
+
+    @property
+    def memm_variance(self):
+        """ Running (sample) variance of the voxel weights, each over its own integration count. """
+        return self.memm_m2 / (self.memm_counts - 1).clamp(min = 1)
 
     def extract_(self, bounds, signs):
         out = bounds[signs]
@@ -217,6 +317,8 @@ class TreeSampling:
         Args:
             origins (torch.Tensor): Tensor (1x3) whose elements define the ray origin positions.
             dirs (torch.Tensor): Tensor (Rx3) whose elements define the ray directions.
+            near (torch.Tensor): Scalar or tensor (R) of the near bounds.
+            far (torch.Tensor): Scalar or tensor (R) of the far bounds.
         Returns:
             z_vals (torch.Tensor): intersection samples as ray direction scalars
             indices (torch.Tensor): indices of valid intersections
@@ -224,6 +326,7 @@ class TreeSampling:
         """
         bounds = self.voxels
         rays_count, voxels_count = dirs.shape[0], bounds.shape[0],
+        near, far = torch.as_tensor(near, device = bounds.device).view(-1, 1), torch.as_tensor(far, device = bounds.device).view(-1, 1)
 
         inv_dirs = 1 / dirs
         signs = (inv_dirs < 0).long()
@@ -342,18 +445,177 @@ class TreeSampling:
 
         return z_vals, indices, ray_mask
 
+    def ray_voxel_traversal(self, origins, dirs, near, far):
+        """ Walks the outer grid (3D-DDA) and descends into the voxels of the crossed cells.
+        Args:
+            origins (torch.Tensor): Tensor (1x3 or Rx3) whose elements define the ray origin positions.
+            dirs (torch.Tensor): Tensor (Rx3) whose elements define the ray directions.
+            near (torch.Tensor): Scalar or tensor (R) of the near bounds.
+            far (torch.Tensor): Scalar or tensor (R) of the far bounds.
+        Returns:
+            hits (RayVoxelHits): ray-voxel crossings within range [ near, far ]
+        """
+        outer_count = self.config.tree.subdivision_outer_count
+        rays_count, device = dirs.shape[0], dirs.device
+        near = torch.as_tensor(near, device = device).view(-1).expand(rays_count)
+        far = torch.as_tensor(far, device = device).view(-1).expand(rays_count)
+
+        origins = origins.view(-1, 3).expand(rays_count, 3)
+        inv_dirs = 1 / dirs
+
+        # Ray intersection with the root bounds
+        bounds_min, bounds_max = self.nodes_bounds[0].to(device)
+        t0, t1 = (bounds_min - origins) * inv_dirs, (bounds_max - origins) * inv_dirs
+        t_enter = torch.min(t0, t1).max(-1).values
+        t_exit = torch.max(t0, t1).min(-1).values
+
+        # Outer grid planes crossings, every consecutive pair of crossings delimits a cell
+        planes = torch.linspace(0., 1., outer_count + 1, device = device)
+        planes = bounds_min[:, None] + (bounds_max - bounds_min)[:, None] * planes
+        crossings = (planes[None] - origins[..., None]) * inv_dirs[..., None]
+        crossings[torch.isnan(crossings)] = float("inf")
+        crossings = crossings.view(rays_count, -1)
+        crossings = torch.max(torch.min(crossings, t_exit[:, None]), t_enter[:, None])
+        crossings = torch.cat((t_enter[:, None], crossings, t_exit[:, None]), -1).sort(-1).values
+
+        # Keep the non-degenerate steps, identify their cells by the step midpoint
+        steps_mask = (crossings[:, 1:] > crossings[:, :-1]) & (t_enter <= t_exit)[:, None]
+        steps_rays, steps_index = steps_mask.nonzero().unbind(-1)
+        steps_mid = (crossings[steps_rays, steps_index] + crossings[steps_rays, steps_index + 1]) / 2
+        points = origins[steps_rays] + dirs[steps_rays] * steps_mid[:, None]
+        cells = ((points - bounds_min) / (bounds_max - bounds_min) * outer_count).long().clamp(0, outer_count - 1)
+        cells = (cells[:, 0] * outer_count + cells[:, 1]) * outer_count + cells[:, 2]
+
+        # Unique (ray, cell) crossings
+        cells_count = outer_count ** 3
+        keys = torch.unique(steps_rays * cells_count + cells)
+        steps_rays, cells = keys // cells_count, keys % cells_count
+
+        # Descend into the voxels of each crossed cell
+        voxels_counts = self.cells_offsets[cells + 1] - self.cells_offsets[cells]
+        pairs_steps = torch.repeat_interleave(torch.arange(cells.shape[0], device = device), voxels_counts)
+        pairs_offsets = torch.arange(pairs_steps.shape[0], device = device) \
+            - (voxels_counts.cumsum(0) - voxels_counts)[pairs_steps]
+        voxels = self.cells_voxels[self.cells_offsets[cells[pairs_steps]] + pairs_offsets]
+        rays = steps_rays[pairs_steps]
+
+        # Voxels spanning several crossed cells are visited once per ray
+        voxels_count = self.voxels.shape[0]
+        keys = torch.unique(rays * voxels_count + voxels)
+        rays, voxels = keys // voxels_count, keys % voxels_count
+
+        # Min, max intersections only for the candidate pairs
+        bounds = self.voxels[voxels]
+        t0 = (bounds[:, 0] - origins[rays]) * inv_dirs[rays]
+        t1 = (bounds[:, 1] - origins[rays]) * inv_dirs[rays]
+        t_in = torch.min(t0, t1).max(-1).values
+        t_out = torch.max(t0, t1).min(-1).values
+
+        # ray cap, as for the dense intersections
+        mask = (t_in <= t_out) & (t_in >= near[rays]) & (t_out <= far[rays])
+        rays, voxels, t_in, t_out = rays[mask], voxels[mask], t_in[mask], t_out[mask]
+
+        # Order by ray then by the entry scalar
+        span = float((far - near).max()) + 1. if rays_count > 0 else 1.
+        order = (rays.double() * span + (t_in.double() - near[rays].double())).argsort()
+        rays, voxels, t_in, t_out = rays[order], voxels[order], t_in[order], t_out[order]
+
+        counts = torch.bincount(rays, minlength = rays_count)
+        offsets = torch.cat((counts.new_zeros(1), counts.cumsum(0)))
+
+        return RayVoxelHits(ray_offsets = offsets, ray_indices = rays, voxel_indices = voxels, t_in = t_in, t_out = t_out)
+
+    def batch_ray_voxel_traverse(self, origins, dirs, near, far, samples_count = 64):
+        """ Sparse counterpart of batch_ray_voxel_intersect, samples only from the traversed hits.
+        Args:
+            origins (torch.Tensor): Tensor (1x3) whose elements define the ray origin positions.
+            dirs (torch.Tensor): Tensor (Rx3) whose elements define the ray directions.
+        Returns:
+            z_vals (torch.Tensor): intersection samples as ray direction scalars
+            indices (torch.Tensor): indices of valid intersections
+            ray_mask (torch.Tensor): ray mask where valid intersections
+        """
+        hits = self.ray_voxel_traversal(origins, dirs, near, far)
+        rays_count, device = dirs.shape[0], dirs.device
+
+        counts = hits.ray_counts
+        ray_mask = counts > 0
+
+        z_vals = torch.zeros(rays_count, samples_count, device = device)
+        indices = torch.zeros(rays_count, samples_count, dtype = torch.long, device = device)
+        if hits.t_in.shape[0] == 0:
+            return z_vals, indices, ray_mask
+
+        # First and last hit of every relevant ray
+        hits_first = hits.ray_offsets[:-1][ray_mask][:, None]
+        hits_last = hits.ray_offsets[1:][ray_mask][:, None] - 1
+
+        if self.config.tree.use_random_sampling:
+            # Uniformly chosen hits, random sampling within
+            samples = torch.rand(hits_first.shape[0], samples_count, device = device)
+            samples = hits_first + (samples * counts[ray_mask][:, None]).long()
+            samples = torch.min(samples, hits_last)
+
+            t_in, t_out = hits.t_in[samples], hits.t_out[samples]
+            values = t_in + (t_out - t_in) * torch.rand_like(t_in)
+        else:
+            # Cumulative sum distances over all the hits, in double to stay exact across rays
+            residuals = (hits.t_out - hits.t_in).double()
+            residuals_cums = torch.cumsum(residuals, 0)
+            residuals_start = residuals_cums - residuals
+
+            # Sampling interval scaled by the total cross distance of each ray
+            cums_first = residuals_start[hits_first]
+            cums_total = residuals_cums[hits_last] - cums_first
+            samples = torch.linspace(0, 1.0, samples_count, device = device, dtype = torch.double)
+            samples = cums_first + samples * cums_total
+
+            # Hit bucket indices, bounded to the ray hits
+            buckets = torch.searchsorted(residuals_cums, samples.contiguous())
+            buckets = torch.max(torch.min(buckets, hits_last), hits_first)
+
+            # Group by bucket (hits) as offset from start (0, 0, 2, 2, 4, 4, 4, ...)
+            samples_positions = torch.searchsorted(buckets, buckets, right = False)
+
+            # Find the sample offset relative to the bucket (hit) 1st sample closest to the near plane
+            samples_offset = (samples - samples.gather(-1, samples_positions)).float()
+
+            # Min hit translate by the offset
+            values = hits.t_in[buckets] + samples_offset
+            samples = buckets
+
+        # Order the samples
+        values, indices_ordered = values.sort(-1)
+
+        z_vals[ray_mask] = values
+        indices[ray_mask] = hits.voxel_indices[samples].gather(-1, indices_ordered)
+
+        return z_vals, indices, ray_mask
+
     def serialize(self):
         return {
-            "root": self.root,
-            "voxels": self.voxels,
+            "nodes_bounds": self.nodes_bounds,
+            "nodes_depths": self.nodes_depths,
+            "nodes_parents": self.nodes_parents,
+            "nodes_children": self.nodes_children,
+            "nodes_weights": self.nodes_weights,
+            "leaves": self.leaves,
             "memm": self.memm,
-            "counter": self.counter
+            "memm_m2": self.memm_m2,
+            "memm_counts": self.memm_counts
         }
 
     def deserialize(self, dict):
         print("Loaded tree from checkpoint...")
-        self.root = dict["root"]
-        self.voxels = dict["voxels"].to(self.device)
+        self.nodes_bounds = dict["nodes_bounds"].to(self.device)
+        self.nodes_depths = dict["nodes_depths"].to(self.device)
+        self.nodes_parents = dict["nodes_parents"].to(self.device)
+        self.nodes_children = dict["nodes_children"].to(self.device)
+        self.nodes_weights = dict["nodes_weights"].to(self.device)
+        self.leaves = dict["leaves"].to(self.device)
+        self.voxels = self.nodes_bounds[self.leaves]
         self.memm = dict["memm"].to(self.device)
-        self.counter = dict["counter"]
+        self.memm_m2 = dict["memm_m2"].to(self.device)
+        self.memm_counts = dict["memm_counts"].to(self.device)
 
+        self.build_cells()
@@ -36,8 +36,8 @@ def main():
         help="Amount of Gpus that should be used(In most cases leave at 1)",
     )
     parser.add_argument(
-        "--precision", type=int, default=32,
-        help="Full precision (32) default, half precision (16) on newer devices to speed up the training.",
+        "--precision", type=str, default=None, choices=["32", "16", "bf16"],
+        help="Overrides the config precision, half (16) or bfloat16 (bf16) autocast of the MLPs to speed up the training.",
     )
     parser.add_argument(
         "--deterministic", action="store_true", default=False,
@@ -53,6 +53,11 @@ def main():
     path_parser = PathParser()
     cfg, logger = path_parser.parse(config_args.config, config_args.log_checkpoint, config_args.run_name, config_args.checkpoint, create_logger = True)
 
+    # Mixed precision, the half precision losses are scaled by the trainer on the GPU
+    if config_args.precision is not None:
+        cfg.experiment.precision = config_args.precision
+    precision = 16 if str(cfg.experiment.get("precision", 32)) == "16" and config_args.gpus > 0 else 32
+
     # # (Optional:) enable this to track autograd issues when debugging
     # torch.autograd.set_detect_anomaly(True)
     if config_args.deterministic:
@@ -83,7 +88,7 @@ def main():
         checkpoint_callback=checkpoint_callback,
         row_log_interval=1,
         log_gpu_memory=None,
-        precision=config_args.precision,
+        precision=precision,
         profiler=profiler,
         fast_dev_run=False,
         deterministic=config_args.deterministic,